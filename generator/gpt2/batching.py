@@ -0,0 +1,126 @@
+import queue
+import threading
+import time
+
+
+class _Request:
+    def __init__(self, prompt, session, stop, options):
+        self.prompt = prompt
+        self.session = session
+        self.stop = stop
+        self.options = options
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class BatchedGenerator:
+    """Front-end that merges generate calls from concurrent sessions into batches.
+
+    Calls are collected for up to batch_window seconds (or until
+    max_batch_size are pending) and then run through the wrapped
+    GPT2Generator as one batched sample_sequence call. It is safe to call
+    generate from many threads. generate_stream and generate_candidates are
+    not batched, they run on the calling thread and take turns with the
+    worker for the model.
+    """
+
+    def __init__(self, generator, max_batch_size=8, batch_window=0.05):
+        self.generator = generator
+        self.max_batch_size = max_batch_size
+        self.batch_window = batch_window
+        self.requests = queue.Queue()
+        self.lock = threading.Lock()
+
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    @property
+    def censor(self):
+        return self.generator.censor
+
+    @censor.setter
+    def censor(self, value):
+        self.generator.censor = value
+
+    @property
+    def max_context_tokens(self):
+        return self.generator.max_context_tokens
+
+    @property
+    def enc(self):
+        return self.generator.enc
+
+    def prompt_replace(self, prompt):
+        return self.generator.prompt_replace(prompt)
+
+    def next_batch(self):
+        batch = [self.requests.get()]
+        deadline = time.time() + self.batch_window
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            try:
+                with self.lock:
+                    texts = self.generator.generate_raw_batch(
+                        [request.prompt for request in batch],
+                        [request.session for request in batch],
+                        [request.stop for request in batch],
+                        [request.options for request in batch],
+                    )
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+                    request.done.set()
+                continue
+
+            for request, text in zip(batch, texts):
+                request.result = text
+                request.done.set()
+
+    def generate_raw(self, prompt, session=None, stop=None, options=None):
+        request = _Request(prompt, session, stop, options)
+        self.requests.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def generate(self, prompt, options=None, seed=None, session=None):
+        prompt = self.generator.prompt_replace(prompt)
+        if seed is not None:
+            options = dict(options or {}, seed=seed)
+        result = self.generator.result_replace(
+            self.generate_raw(prompt, session=session, options=options)
+        )
+        if len(result) == 0:
+            return self.generate(
+                prompt, self.generator.retry_options(options), session=session
+            )
+        return result
+
+    def generate_stream(self, prompt, options=None, session=None):
+        """GPT2Generator.generate_stream, batches of other sessions can run between the chunks."""
+        stream = self.generator.generate_stream(prompt, options=options, session=session)
+        while True:
+            with self.lock:
+                chunk = next(stream, None)
+            if chunk is None:
+                return
+            yield chunk
+
+    def generate_candidates(self, prompt, num_candidates, options=None, session=None):
+        with self.lock:
+            return self.generator.generate_candidates(
+                prompt, num_candidates, options=options, session=session
+            )
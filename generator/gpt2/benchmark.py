@@ -0,0 +1,119 @@
+"""Measures how fast a GPT2Generator runs a fixed prefill and decode workload.
+
+    python -m generator.gpt2.benchmark --cpu --xla
+
+prints the prefill time, the time per decoded token and tokens per second,
+with --xla the speedup of the XLA compiled graph over the plain one and
+with --draft-model how many of the draft's tokens were accepted.
+"""
+
+import argparse
+import gc
+import time
+
+from generator.gpt2.gpt2_generator import GPT2Generator
+
+PROMPT = (
+    "You are a knight living in the kingdom of Larion. You have a steel longsword "
+    "and a wooden shield. You are on a quest to defeat the evil dragon of Larion's "
+    "mountain. You've heard he lives up at the north of the kingdom. You set on the "
+    "path to defeat him and walk into a dark forest. As you enter the forest you see "
+    "a dark figure standing between the trees. He is wearing a black cloak and holds "
+    "a staff that glows with a pale blue light.\n> You ask him who he is\n"
+)
+
+
+def time_generation(generator, prompt, generate_num, runs):
+    """Average seconds of one generation of exactly generate_num tokens."""
+    options = {"generate_num": generate_num}
+    # The first run pays for allocations and compilation
+    generator.generate_raw(prompt, stop=[], options=options)
+    start = time.time()
+    for _ in range(runs):
+        generator.generate_raw(prompt, stop=[], options=options)
+    return (time.time() - start) / runs
+
+
+def measure(generator, prompt=PROMPT, generate_num=60, runs=3):
+    """Times prefill (a single token generation) and decode of generator.
+
+    The generator should be created with cache_sessions=0, otherwise every
+    run after the first reuses the cached prompt and skips the prefill.
+    """
+    prefill = time_generation(generator, prompt, 1, runs)
+    total = time_generation(generator, prompt, generate_num, runs)
+    return {
+        "prefill": prefill,
+        "decode": (total - prefill) / max(generate_num - 1, 1),
+        "tokens_per_second": generate_num / total,
+    }
+
+
+def report(name, result):
+    print(
+        "%s: prefill %.3fs, decode %.1fms/token, %.2f tokens/s"
+        % (name, result["prefill"], result["decode"] * 1000, result["tokens_per_second"])
+    )
+
+
+def run(generate_num, runs, **kwargs):
+    generator = GPT2Generator(cache_sessions=0, **kwargs)
+    result = measure(generator, generate_num=generate_num, runs=runs)
+    result["xla"] = getattr(generator.engine, "xla", False)
+    result["acceptance_rate"] = getattr(generator.engine, "acceptance_rate", None)
+    # Free the model before the next configuration is loaded
+    del generator
+    gc.collect()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser("Benchmark GPT2Generator")
+    parser.add_argument("--cpu", action="store_true", help="Force using CPU instead of GPU.")
+    parser.add_argument("--backend", choices=["tf", "numpy"], default="tf")
+    parser.add_argument("--quantize", choices=["int8", "float16"])
+    parser.add_argument("--fixed-cache", action="store_true")
+    parser.add_argument(
+        "--prefill-chunk", type=int, help="Run the prompt this many tokens at a time."
+    )
+    parser.add_argument(
+        "--xla", action="store_true", help="Also run with XLA and report the speedup."
+    )
+    parser.add_argument(
+        "--draft-model", help="Speculative decoding with this model, needs --backend numpy."
+    )
+    parser.add_argument("--draft-tokens", type=int, default=4)
+    parser.add_argument("--generate-num", type=int, default=60)
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    settings = dict(
+        force_cpu=args.cpu,
+        backend=args.backend,
+        quantize=args.quantize,
+        fixed_cache=args.fixed_cache,
+        prefill_chunk=args.prefill_chunk,
+        draft_model=args.draft_model,
+        draft_tokens=args.draft_tokens,
+    )
+    baseline = run(args.generate_num, args.runs, **settings)
+    report("baseline", baseline)
+    if args.draft_model is not None:
+        print("draft tokens accepted: %.0f%%" % (baseline["acceptance_rate"] * 100))
+    if args.xla:
+        result = run(args.generate_num, args.runs, xla=True, **settings)
+        report("xla", result)
+        if not result["xla"]:
+            print("XLA compilation failed, both runs used the plain graph")
+            return
+        print(
+            "XLA speedup: prefill %.2fx, decode %.2fx"
+            % (
+                baseline["prefill"] / result["prefill"],
+                baseline["decode"] / result["decode"],
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,31 @@
+import sys
+import time
+
+from generator.gpt2.src import encoder
+
+if len(sys.argv) != 2:
+    print(
+        "You must enter the model directory as a parameter, e.g.: "
+        "python -m generator.gpt2.compile_vocab generator/gpt2/models/model_v5"
+    )
+    sys.exit(1)
+
+model_dir = sys.argv[1]
+
+try:
+    path = encoder.compile_vocab(model_dir)
+except ValueError as e:
+    print("Cannot compile the vocabulary, the encoder keeps loading the JSON: %s" % e)
+    sys.exit(1)
+
+_, _, checksum = encoder.read_sources(model_dir)
+start = time.time()
+encoder.parse_sources(*encoder.read_sources(model_dir)[:2])
+parsed = time.time() - start
+start = time.time()
+encoder.load_compiled_vocab(model_dir, checksum)
+loaded = time.time() - start
+print(
+    "Compiled the vocabulary to %s, it loads in %.1fms instead of %.1fms"
+    % (path, loaded * 1000, parsed * 1000)
+)
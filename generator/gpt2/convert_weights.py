@@ -0,0 +1,50 @@
+import json
+import os
+import sys
+
+from generator.gpt2.src import encoder, numpy_model, quantize, weights
+
+# Only used to check how much a quantized conversion changes the logits
+SAMPLE_TEXT = (
+    "You are a knight living in the kingdom of Larion. You have a steel longsword "
+    "and a wooden shield. You are on a quest to defeat the evil dragon of Larion's "
+    "mountain. You enter the cave and see the dragon sleeping on a pile of gold."
+)
+
+if len(sys.argv) not in (2, 3) or sys.argv[2:] not in ([], ["int8"], ["float16"]):
+    print(
+        "You must enter the model directory as a parameter, optionally followed by "
+        "int8 or float16, e.g.: "
+        "python -m generator.gpt2.convert_weights generator/gpt2/models/model_v5 int8"
+    )
+    sys.exit(1)
+
+checkpoint_dir = sys.argv[1]
+mode = sys.argv[2] if len(sys.argv) == 3 else None
+
+manifest = weights.convert(checkpoint_dir, quantize=mode)
+path = weights.store_paths(checkpoint_dir, mode)[0]
+print(
+    "Converted %s: %d tensors, %.1f MB in %s"
+    % (manifest["checkpoint"], len(manifest["tensors"]), os.path.getsize(path) / 1e6, path)
+)
+
+if mode is not None:
+    hparams = numpy_model.default_hparams()
+    with open(os.path.join(checkpoint_dir, "hparams.json")) as f:
+        hparams.override_from_dict(json.load(f))
+    models_dir, model_name = os.path.split(os.path.normpath(checkpoint_dir))
+    tokens = encoder.get_encoder(model_name, models_dir).encode(SAMPLE_TEXT)
+
+    if weights.open_store(checkpoint_dir) is None:
+        weights.convert(checkpoint_dir)
+    error, agreement = quantize.compare_logits(
+        hparams,
+        weights.open_store(checkpoint_dir),
+        weights.open_store(checkpoint_dir, mode),
+        tokens[: hparams.n_ctx],
+    )
+    print(
+        "Largest logit difference to float32: %.4f, same top token at %.1f%% of positions"
+        % (error, agreement * 100)
+    )
@@ -0,0 +1,53 @@
+"""Writes the most common pre-tokens of the story corpora for warming the encoder cache.
+
+    python -m generator.gpt2.count_pretokens data/text_adventures.txt data/writing_prompts.txt
+
+counts the pre-tokens of the corpora and writes the most common ones, one
+per line and the most common first, to common_pretokens.txt in the model
+directory. Every line also has the merged form of the pre-token, which
+get_encoder puts into the cache of every new Encoder as it is, so the first
+turns of a story do not pay for the merges of common words and loading an
+encoder does not either.
+"""
+
+import argparse
+import collections
+import os
+
+from generator.gpt2.src import encoder
+
+
+def main():
+    parser = argparse.ArgumentParser("Count the most common pre-tokens of a corpus")
+    parser.add_argument("corpora", nargs="+", help="Text files to count.")
+    parser.add_argument("--model-dir", default="generator/gpt2/models/model_v5")
+    parser.add_argument(
+        "--count",
+        type=int,
+        default=encoder.CACHE_SIZE // 2,
+        help="How many to write, leave the rest of the cache for the words of the stories.",
+    )
+    args = parser.parse_args()
+
+    models_dir, model_name = os.path.split(os.path.normpath(args.model_dir))
+    enc = encoder.get_encoder(model_name, models_dir, cache_size=0)
+    counts = collections.Counter()
+    for path in args.corpora:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                counts.update(enc.pretokens(line))
+
+    common = [token for token, _ in counts.most_common() if len(token) > 1][: args.count]
+    path = os.path.join(args.model_dir, encoder.COMMON_PRETOKENS)
+    with open(path, "w", encoding="utf-8") as f:
+        encoder.write_common_pretokens(f, enc, common)
+
+    covered = sum(counts[token] for token in common)
+    print(
+        "Wrote %d of %d distinct pre-tokens to %s, they are %.1f%% of the corpora"
+        % (len(common), len(counts), path, covered / max(sum(counts.values()), 1) * 100)
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""Thread and replica settings for running the model on a CPU host.
+
+tune.py benchmarks a grid of settings and writes a profile to
+cpu_profile.json in the model directory, GPT2Generator loads it from there
+when it runs the TensorFlow backend on the CPU. A setting holds the intra
+and inter op thread counts of every TensorFlow session and the number of
+replicas per socket. With pin every replica is bound to its own share of
+the cores of one socket, replica i of a host being the i-th such share.
+
+The profile keeps the fastest setting of a single process ("single") and
+the one with the most tokens per second over all of its replicas
+("replicas"), and the fixed_cache and prefill_chunk they were tuned with
+("settings"). Only a process that is started as one of several replicas
+should use the second.
+"""
+
+import json
+import os
+import platform
+
+PROFILE = "cpu_profile.json"
+
+
+def available_cpus():
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+
+def sockets():
+    """Lists the available CPUs of every socket, one socket if the topology is unknown."""
+    cpus = available_cpus()
+    packages = {}
+    for cpu in cpus:
+        path = "/sys/devices/system/cpu/cpu%d/topology/physical_package_id" % cpu
+        try:
+            with open(path) as f:
+                package = int(f.read())
+        except (OSError, ValueError):
+            return [cpus]
+        packages.setdefault(package, []).append(cpu)
+    return [packages[package] for package in sorted(packages)]
+
+
+def replica_cpus(replicas_per_socket, replica):
+    """The CPUs replica is pinned to, replicas fill one socket after the other."""
+    socket = sockets()[replica // replicas_per_socket % len(sockets())]
+    share = len(socket) // replicas_per_socket
+    start = replica % replicas_per_socket * share
+    return socket[start : start + share]
+
+
+def pin(cpus):
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)
+
+
+def apply(profile, replica=None):
+    """Returns the TFEngine thread settings of profile.
+
+    Without replica they are the ones of a single process. With replica
+    they are the ones of the replicas and this process is pinned to the
+    CPUs of replica if the setting asks for it.
+    """
+    if replica is None:
+        setting = profile["single"]
+    else:
+        setting = profile["replicas"]
+        if setting["pin"]:
+            pin(replica_cpus(setting["replicas_per_socket"], replica))
+    return {
+        "intra_op_threads": setting["intra_op_threads"],
+        "inter_op_threads": setting["inter_op_threads"],
+    }
+
+
+def host():
+    return {"name": platform.node(), "cpus": len(available_cpus()), "sockets": len(sockets())}
+
+
+def save(checkpoint_dir, profile):
+    profile = dict(profile, host=host())
+    with open(os.path.join(checkpoint_dir, PROFILE), "w") as f:
+        json.dump(profile, f, indent=1)
+    return profile
+
+
+def load(checkpoint_dir):
+    """Returns the profile of checkpoint_dir, None if there is none or it was tuned for other CPUs."""
+    path = os.path.join(checkpoint_dir, PROFILE)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        profile = json.load(f)
+    if "single" not in profile:
+        # Written by an older tune.py
+        return None
+    tuned = profile.get("host", {})
+    current = host()
+    if tuned.get("cpus") != current["cpus"] or tuned.get("sockets") != current["sockets"]:
+        return None
+    return profile
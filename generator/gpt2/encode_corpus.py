@@ -0,0 +1,50 @@
+"""Encodes a training corpus into a file of uint16 token ids with document offsets.
+
+    python -m generator.gpt2.encode_corpus data/text_adventures.txt data/text_adventures.tokens
+
+spreads the documents over one process per CPU and writes the ids in
+order; load them again with encoder.load_tokens.
+"""
+
+import argparse
+import os
+import time
+
+from generator.gpt2.src import encoder
+
+
+def main():
+    parser = argparse.ArgumentParser("Encode a corpus into token ids")
+    parser.add_argument("corpus", help="Text file to encode.")
+    parser.add_argument("output", help="Where the ids are written.")
+    parser.add_argument("--model-dir", default="generator/gpt2/models/model_v5")
+    parser.add_argument("--processes", type=int, default=os.cpu_count())
+    parser.add_argument(
+        "--separator",
+        default=encoder.END_OF_TEXT,
+        help="Lines ending with it end a document.",
+    )
+    args = parser.parse_args()
+
+    models_dir, model_name = os.path.split(os.path.normpath(args.model_dir))
+    enc = encoder.get_encoder(model_name, models_dir)
+    start = time.time()
+    tokens, offsets = enc.encode_file(
+        args.corpus, args.output, processes=args.processes, separator=args.separator
+    )
+    elapsed = time.time() - start
+    print(
+        "%d documents, %d tokens in %.1fs (%.0f tokens/s) with %d processes, written to %s"
+        % (
+            len(offsets) - 1,
+            len(tokens),
+            elapsed,
+            len(tokens) / max(elapsed, 1e-9),
+            args.processes,
+            args.output,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""Measures the BPE encoder on the training corpora and checks it against the original merge loop.
+
+    python -m generator.gpt2.encoder_benchmark data/text_adventures.txt data/writing_prompts.txt
+
+(the files written by data/build_training_data.py and data/make_reddit_data.py)
+merges every distinct pre-token of the corpora with both implementations,
+fails on the first token they split differently, and prints their times
+and how fast the whole corpora encode with a fresh cache and how often
+it hits.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+from generator.gpt2.src import encoder
+
+
+def reference_bpe(token, bpe_ranks):
+    """The merge loop Encoder.bpe used before merge_symbols."""
+    word = tuple(token)
+    pairs = encoder.get_pairs(word)
+
+    if not pairs:
+        return token
+
+    while True:
+        bigram = min(pairs, key=lambda pair: bpe_ranks.get(pair, float("inf")))
+        if bigram not in bpe_ranks:
+            break
+        first, second = bigram
+        new_word = []
+        i = 0
+        while i < len(word):
+            try:
+                j = word.index(first, i)
+                new_word.extend(word[i:j])
+                i = j
+            except ValueError:
+                new_word.extend(word[i:])
+                break
+
+            if word[i] == first and i < len(word) - 1 and word[i + 1] == second:
+                new_word.append(first + second)
+                i += 2
+            else:
+                new_word.append(word[i])
+                i += 1
+        word = tuple(new_word)
+        if len(word) == 1:
+            break
+        pairs = encoder.get_pairs(word)
+    return " ".join(word)
+
+
+def read_corpora(paths, limit):
+    texts = []
+    size = 0
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            text = f.read(limit - size if limit else -1)
+        texts.append(text)
+        size += len(text)
+        if limit and size >= limit:
+            break
+    return texts
+
+
+def distinct_pretokens(enc, texts):
+    tokens = set()
+    for text in texts:
+        tokens.update(enc.pretokens(text))
+    # Longest first, those are the ones the merge loop is slow on
+    return sorted(tokens, key=lambda token: (-len(token), token))
+
+
+def main():
+    parser = argparse.ArgumentParser("Benchmark the BPE encoder")
+    parser.add_argument("corpora", nargs="+", help="Text files to encode.")
+    parser.add_argument("--model-dir", default="generator/gpt2/models/model_v5")
+    parser.add_argument(
+        "--limit", type=int, help="Only read this many characters of the corpora."
+    )
+    args = parser.parse_args()
+
+    models_dir, model_name = os.path.split(os.path.normpath(args.model_dir))
+    enc = encoder.get_encoder(model_name, models_dir)
+    texts = read_corpora(args.corpora, args.limit)
+    tokens = distinct_pretokens(enc, texts)
+    print(
+        "%d characters, %d distinct pre-tokens, longest %d"
+        % (sum(len(text) for text in texts), len(tokens), len(tokens[0]) if tokens else 0)
+    )
+
+    start = time.time()
+    expected = [reference_bpe(token, enc.bpe_ranks) for token in tokens]
+    reference = time.time() - start
+
+    start = time.time()
+    merged = [" ".join(encoder.merge_symbols(token, enc.bpe_ranks)) for token in tokens]
+    linked = time.time() - start
+
+    for token, want, got in zip(tokens, expected, merged):
+        if len(token) > 1 and want != got:
+            print("Different merges of %r: %r instead of %r" % (token, got, want))
+            sys.exit(1)
+    print("merges: original %.2fs, linked list %.2fs, %.2fx" % (reference, linked, reference / linked))
+
+    enc = encoder.get_encoder(model_name, models_dir)
+    start = time.time()
+    count = sum(len(enc.encode(text)) for text in texts)
+    elapsed = time.time() - start
+    print(
+        "encode: %d tokens in %.2fs, %.0f tokens/s"
+        % (count, elapsed, count / elapsed if elapsed else float("inf"))
+    )
+    print(
+        "cache: %d of %d entries, %.1f%% hits, %d evictions"
+        % (len(enc.cache), enc.cache.capacity, enc.cache.hit_rate() * 100, enc.cache.evictions)
+    )
+
+
+if __name__ == "__main__":
+    main()
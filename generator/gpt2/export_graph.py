@@ -0,0 +1,44 @@
+"""Exports the sampling graph of a model as one optimized artifact.
+
+    python -m generator.gpt2.export_graph generator/gpt2/models/model_v5 \\
+        generator/gpt2/models/model_v5/export --fixed-cache
+
+GPT2Generator(export_dir=...) (or play.py --export) then loads it instead
+of building the graph in python.
+"""
+
+import argparse
+
+from generator.gpt2.tf_engine import TFEngine
+
+
+def main():
+    parser = argparse.ArgumentParser("Export the GPT-2 sampling graph")
+    parser.add_argument("checkpoint_dir")
+    parser.add_argument("export_dir")
+    parser.add_argument("--cpu", action="store_true", help="Force using CPU instead of GPU.")
+    parser.add_argument("--fixed-cache", action="store_true")
+    parser.add_argument(
+        "--prefill-chunk", type=int, help="Run the prompt this many tokens at a time."
+    )
+    args = parser.parse_args()
+
+    engine = TFEngine(
+        args.checkpoint_dir,
+        force_cpu=args.cpu,
+        fixed_cache=args.fixed_cache,
+        prefill_chunk=args.prefill_chunk,
+    )
+    manifest = engine.export(args.export_dir)
+    print(
+        "Exported %s to %s (%s)"
+        % (
+            manifest["config"],
+            args.export_dir,
+            "weights frozen" if manifest["frozen"] else "weights restored from the checkpoint",
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,90 @@
-import json
 import os
+import re
 import warnings
+from collections import OrderedDict
 
 import numpy as np
 
-import tensorflow as tf
-from generator.gpt2.src import encoder, model, sample
+from generator.gpt2 import cpu_profile
+from generator.gpt2.src import checkpoint, encoder
 from story.utils import *
 
 warnings.filterwarnings("ignore")
 
-tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
+# A finished sentence, the whitespace after it shows that no more punctuation follows
+SENTENCE_END = re.compile(r'[.!?]+"?(?=\s)')
+
+
+def finished_sentences(text):
+    """Length of the longest prefix of text that ends with a finished sentence outside of quotes.
+
+    Only prefixes that cut_trailing_sentence keeps however text goes on
+    count: nothing after the last punctuation (a closing quote may still
+    be cut with it), after a < or >, after an unmatched quote or after the
+    last line break, since the line after it is cut if it ends up as the
+    last line and an action.
+    """
+    limit = max(text.rfind("."), text.rfind("!"), text.rfind("?")) + 1
+    for token in "<>":
+        index = text.find(token)
+        if index > 0:
+            limit = min(limit, index)
+    if text.count('"', 0, limit) % 2 == 1:
+        limit = text.rfind('"', 0, limit)
+    newline = text.rfind("\n", 0, limit)
+    if newline >= 0:
+        limit = newline
+    end = 0
+    for match in SENTENCE_END.finditer(text, 0, limit + 1):
+        if match.end() <= limit and text.count('"', 0, match.end()) % 2 == 0:
+            end = match.end()
+    return end
+
+
+def sequences_batch(sequences):
+    """Lays out lists of token sequences as a [rows, sequences, length] array.
+
+    Every sequence is right aligned and padded with -1, as sample.stopped
+    and sample.ban_sequences expect them.
+    """
+    count = max([1] + [len(s) for s in sequences])
+    width = max([1] + [len(seq) for s in sequences for seq in s])
+    batch = np.full([len(sequences), count, width], -1, dtype=np.int32)
+    for i, s in enumerate(sequences):
+        for j, seq in enumerate(s):
+            batch[i, j, width - len(seq) :] = seq
+    return batch
+
+
+def word_breaks(enc, n_vocab):
+    """The word_breaks of sample.ban_sequences for the tokens of enc."""
+
+    def in_word(byte):
+        # Bytes of non-ASCII characters count as letters
+        return byte >= 0x80 or chr(byte).isalnum()
+
+    breaks = np.zeros([n_vocab], dtype=np.int32)
+    for token, index in enc.encoder.items():
+        data = bytes(enc.byte_decoder[c] for c in token)
+        if index >= n_vocab or len(data) == 0:
+            continue
+        breaks[index] = (0 if in_word(data[0]) else 1) | (0 if in_word(data[-1]) else 2)
+    return breaks
+
+
+def held_back(text, stop):
+    """Length of the longest end of text that is the start of one of the stop strings."""
+    held = 0
+    for s in stop:
+        for length in range(min(len(s) - 1, len(text)), held, -1):
+            if text.endswith(s[:length]):
+                held = length
+                break
+    return held
 
 
 class GPT2Generator:
-    def __init__(self, generate_num=60, temperature=0.4, top_k=40, top_p=0.9, censor=True, force_cpu=False):
+    def __init__(self, generate_num=60, temperature=0.4, top_k=40, top_p=0.9, censor=True, force_cpu=False, cache_sessions=1, max_context_tokens=None, fixed_cache=None, backend="tf", quantize=None, xla=False, prefill_chunk=None, export_dir=None, draft_model=None, draft_tokens=4, result_cache=None, profile=None, replica=None):
         self.generate_num = generate_num
         self.temp = temperature
         self.top_k = top_k
@@ -26,43 +96,89 @@ class GPT2Generator:
         self.checkpoint_path = os.path.join(self.model_dir, self.model_name)
 
         models_dir = os.path.expanduser(os.path.expandvars(self.model_dir))
-        self.batch_size = 1
-        self.samples = 1
 
         self.enc = encoder.get_encoder(self.model_name, models_dir)
-        hparams = model.default_hparams()
-        with open(os.path.join(models_dir, self.model_name, "hparams.json")) as f:
-            hparams.override_from_dict(json.load(f))
-        seed = np.random.randint(0, 100000)
-
-        config = None
-        if force_cpu:
-            config = tf.compat.v1.ConfigProto(
-                device_count={"GPU": 0}
+        self.pad_token = self.enc.encoder["<|endoftext|>"]
+
+        # Anything after these is cut off by cut_trailing_sentence anyway
+        self.stop = ["<", ">"]
+        self.stop_cache = {}
+        # With censor the sampler masks these instead of censoring the text afterwards
+        self.banned = self.banned_token_sequences(censored_words)
+
+        # The backends are imported lazily so the numpy one never loads tensorflow
+        checkpoint_dir = os.path.join(models_dir, self.model_name)
+        if backend == "tf":
+            if quantize is not None:
+                raise ValueError("Quantized weights need the numpy backend")
+            if draft_model is not None:
+                raise ValueError("Draft models need the numpy backend")
+            from generator.gpt2.tf_engine import TFEngine
+
+            # Thread settings found by tune.py for this host, pinned only as one of several replicas
+            if profile is None and force_cpu:
+                profile = cpu_profile.load(checkpoint_dir)
+            threads = {}
+            if profile is not None:
+                threads = cpu_profile.apply(profile, replica)
+
+            self.engine = TFEngine(
+                checkpoint_dir,
+                force_cpu=force_cpu,
+                fixed_cache=fixed_cache,
+                xla=xla,
+                prefill_chunk=prefill_chunk,
+                export_dir=export_dir,
+                **threads
+            )
+        elif backend == "numpy":
+            if xla or export_dir is not None:
+                raise ValueError("XLA and exported graphs need the tf backend")
+            from generator.gpt2.numpy_engine import NumpyEngine
+
+            self.engine = NumpyEngine(
+                checkpoint_dir,
+                quantize=quantize,
+                prefill_chunk=prefill_chunk,
+                draft_dir=None
+                if draft_model is None
+                else os.path.join(models_dir, draft_model),
+                draft_tokens=draft_tokens,
             )
         else:
-            config = tf.compat.v1.ConfigProto()
-            config.gpu_options.allow_growth = True
-        self.sess = tf.compat.v1.Session(config=config)
-
-        self.context = tf.placeholder(tf.int32, [self.batch_size, None])
-        # np.random.seed(seed)
-        # tf.set_random_seed(seed)
-        self.output = sample.sample_sequence(
-            hparams=hparams,
-            length=self.generate_num,
-            context=self.context,
-            batch_size=self.batch_size,
-            temperature=temperature,
-            top_k=top_k,
-            top_p=top_p,
-        )
+            raise ValueError("Unknown backend %r, use 'tf' or 'numpy'" % backend)
+        hparams = self.engine.hparams
+        self.hparams = hparams
+        self.word_breaks = word_breaks(self.enc, hparams.n_vocab)
+
+        # Prompts have to leave room for the generated tokens in n_ctx
+        self.max_prompt_tokens = hparams.n_ctx - generate_num
+        if max_context_tokens is None:
+            max_context_tokens = self.max_prompt_tokens
+        self.max_context_tokens = min(max_context_tokens, self.max_prompt_tokens)
+
+        # session -> (tokens, presents) from the last generation of that session
+        self.cache_sessions = cache_sessions
+        self.session_cache = OrderedDict()
 
-        saver = tf.train.Saver()
-        ckpt = tf.train.latest_checkpoint(os.path.join(models_dir, self.model_name))
-        saver.restore(self.sess, ckpt)
+        # Seeded generations are looked up in result_cache (a ResultCache) first
+        self.result_cache = result_cache
+        prefix = None
+        if os.path.exists(os.path.join(checkpoint_dir, "checkpoint")):
+            prefix = checkpoint.latest_checkpoint(checkpoint_dir)
+        self.model_id = {
+            "model": self.model_name,
+            "checkpoint": None if prefix is None else os.path.basename(prefix),
+            "backend": backend,
+            "quantize": quantize,
+            "draft_model": draft_model,
+            "draft_tokens": draft_tokens,
+        }
 
     def prompt_replace(self, prompt):
+        # Token ids are from text that was already replaced
+        if not isinstance(prompt, str):
+            return prompt
         # print("\n\nBEFORE PROMPT_REPLACE:")
         # print(repr(prompt))
         if len(prompt) > 0 and prompt[-1] == " ":
@@ -81,14 +197,15 @@ class GPT2Generator:
         result = cut_trailing_sentence(result)
         if len(result) == 0:
             return ""
+        return self.clean_result(result)
+
+    def clean_result(self, result):
         first_letter_capitalized = result[0].isupper()
         result = result.replace('."', '".')
         result = result.replace("#", "")
         result = result.replace("*", "")
         result = result.replace("\n\n", "\n")
         # result = first_to_second_person(result)
-        if self.censor:
-            result = remove_profanity(result)
 
         if not first_letter_capitalized:
             result = result[0].lower() + result[1:]
@@ -99,22 +216,322 @@ class GPT2Generator:
 
         return result
 
-    def generate_raw(self, prompt):
-        context_tokens = self.enc.encode(prompt)
-        generated = 0
-        for _ in range(self.samples // self.batch_size):
-            out = self.sess.run(
-                self.output,
-                feed_dict={
-                    self.context: [context_tokens for _ in range(self.batch_size)]
-                },
-            )[:, len(context_tokens) :]
-            for i in range(self.batch_size):
-                generated += 1
-                text = self.enc.decode(out[i])
+    def prompt_tokens(self, prompt):
+        """Token ids of prompt, which can be text or already token ids."""
+        if isinstance(prompt, str):
+            return self.enc.encode(prompt)
+        return list(prompt)
+
+    def cached_past(self, context_tokens, session=None):
+        """Returns the cached presents of session that are still valid for context_tokens.
+
+        Keys and values only depend on the tokens before them, so the cache is
+        usable up to the longest common prefix with the tokens it was built
+        from. Once the story window slides the prefix no longer matches and
+        the cache is dropped.
+        """
+        empty = np.zeros(
+            self.engine.past_shape(batch_size=1, sequence=0),
+            dtype=np.float32,
+        )
+        if session not in self.session_cache:
+            return empty
+        cached_tokens, presents = self.session_cache.pop(session)
+
+        # At least one token has to be fed to get logits for the next one
+        limit = min(len(cached_tokens), len(context_tokens) - 1)
+        common = 0
+        while common < limit and cached_tokens[common] == context_tokens[common]:
+            common += 1
+        if common == 0:
+            return empty
+        return presents[..., :common, :]
+
+    def cache_past(self, tokens, presents, session=None):
+        if self.cache_sessions <= 0:
+            return
+        self.session_cache[session] = (tokens[: presents.shape[-2]], presents)
+        self.session_cache.move_to_end(session)
+        while len(self.session_cache) > self.cache_sessions:
+            self.session_cache.popitem(last=False)
+
+    def stop_token_sequences(self, stop):
+        """Token sequences that end a generation once any of the stop strings is produced.
+
+        Every single token containing a stop string stops on its own, longer
+        stop strings also stop on their own encoding.
+        """
+        stop = tuple(stop)
+        if stop not in self.stop_cache:
+            sequences = []
+            if len(stop) > 0:
+                for token in range(len(self.enc.encoder)):
+                    text = self.enc.decode([token])
+                    if any(s in text for s in stop):
+                        sequences.append([token])
+                for s in stop:
+                    tokens = self.enc.encode(s)
+                    if len(tokens) > 1:
+                        sequences.append(tokens)
+            self.stop_cache[stop] = sequences
+        return self.stop_cache[stop]
+
+    def stop_sequences_batch(self, stops):
+        return sequences_batch([self.stop_token_sequences(stop) for stop in stops])
+
+    def banned_token_sequences(self, words):
+        """Token sequences of words the way they show up in text.
+
+        Every word is encoded with and without a leading space, in lower
+        case, capitalized, upper case and as written. The sampler bans them
+        where they start a word, see sample.ban_sequences.
+        """
+        sequences = set()
+        for word in words:
+            for variant in {word, word.lower(), word.capitalize(), word.upper()}:
+                for text in (variant, " " + variant):
+                    sequences.add(tuple(self.enc.encode(text)))
+        return sorted(sequences)
+
+    def banned_sequences_batch(self, batch_size):
+        """Token sequences the sampler never completes, None if censoring is off."""
+        if not self.censor:
+            return None
+        return sequences_batch([self.banned] * batch_size)
+
+    def cut_at_stop(self, text, stop):
+        for s in stop:
+            index = text.find(s)
+            if index >= 0:
+                text = text[:index]
         return text
 
-    def generate(self, prompt, options=None, seed=1):
+    def sampling_options(self, options=None):
+        """Returns the sampling settings of one call, the generator's own are the defaults."""
+        values = {
+            "generate_num": self.generate_num,
+            "temperature": self.temp,
+            "top_k": self.top_k,
+            "top_p": self.top_p,
+            # Used tokens get their logits scaled, 0 counts the whole prompt
+            "repetition_penalty": 0.85,
+            "presence_penalty": 0.0,
+            "frequency_penalty": 0.0,
+            "penalty_window": 0,
+            # An int in [0, 2 ** 31) makes the result reproducible, None is random
+            "seed": None,
+        }
+        if options is not None:
+            for key in values:
+                if key in options:
+                    values[key] = options[key]
+        return values
+
+    def generate_raw_batch(self, prompts, sessions=None, stops=None, options=None):
+        """Generates a continuation for every prompt in a single batched run.
+
+        Rows are left padded to a common length. A row that has a cached past
+        is laid out as [padding, cached tokens, padding, new tokens] so the
+        cached keys and values line up with the batched past. Decoding ends
+        once every row produced one of its stop strings (self.stop by default),
+        which is cut from the returned text. options holds the sampling
+        settings of every row. Seeded rows found in result_cache are not run.
+        A prompt can be text or token ids.
+        """
+        if sessions is None:
+            sessions = [None] * len(prompts)
+        if stops is None:
+            stops = [None] * len(prompts)
+        if options is None:
+            options = [None] * len(prompts)
+        stops = [self.stop if stop is None else stop for stop in stops]
+        options = [self.sampling_options(o) for o in options]
+
+        keys = [
+            self.result_key(prompt, stop, o)
+            for prompt, stop, o in zip(prompts, stops, options)
+        ]
+        texts = [None if key is None else self.result_cache.get(key) for key in keys]
+        missing = [i for i, text in enumerate(texts) if text is None]
+        if len(missing) > 0:
+            generated = self.run_batch(
+                [prompts[i] for i in missing],
+                [sessions[i] for i in missing],
+                [stops[i] for i in missing],
+                [options[i] for i in missing],
+            )
+            for i, text in zip(missing, generated):
+                texts[i] = text
+                if keys[i] is not None:
+                    self.result_cache.put(keys[i], text)
+        return texts
+
+    def result_key(self, prompt, stop, options):
+        """Key of the result in result_cache, None if it is not cached."""
+        if self.result_cache is None or options["seed"] is None:
+            return None
+        max_prompt_tokens = self.hparams.n_ctx - options["generate_num"]
+        return self.result_cache.key(
+            model=self.model_id,
+            tokens=self.prompt_tokens(prompt)[-max_prompt_tokens:],
+            stop=list(stop),
+            options=options,
+            censor=self.censor,
+        )
+
+    def run_batch(self, prompts, sessions, stops, options):
+        """Runs the batch through the engine, stops and options are already filled in."""
+        context, mask, past = self.batch_inputs(prompts, sessions, options)
+        output = self.engine.generate(
+            context,
+            mask,
+            past,
+            self.stop_sequences_batch(stops),
+            options,
+            self.banned_sequences_batch(len(prompts)),
+            self.word_breaks,
+        )
+        self.cache_outputs(sessions, mask, output)
+
+        out, lengths = output["tokens"], output["lengths"]
+        texts = []
+        for i in range(len(prompts)):
+            generated = out[i, len(mask[i]) : len(mask[i]) + lengths[i]]
+            texts.append(self.cut_at_stop(self.enc.decode(generated), stops[i]))
+        return texts
+
+    def batch_inputs(self, prompts, sessions, options):
+        """Left pads the prompts into the context, mask and past of one batch, see generate_raw_batch."""
+        rows = []
+        for prompt, session, o in zip(prompts, sessions, options):
+            max_prompt_tokens = self.hparams.n_ctx - o["generate_num"]
+            context_tokens = self.prompt_tokens(prompt)[-max_prompt_tokens:]
+            rows.append((context_tokens, self.cached_past(context_tokens, session)))
+        past_length = max(past.shape[-2] for _, past in rows)
+        new_length = max(len(tokens) - past.shape[-2] for tokens, past in rows)
+
+        context, mask, pasts = [], [], []
+        for context_tokens, past in rows:
+            cached = past.shape[-2]
+            new = len(context_tokens) - cached
+            context.append(
+                [self.pad_token] * (past_length - cached)
+                + context_tokens[:cached]
+                + [self.pad_token] * (new_length - new)
+                + context_tokens[cached:]
+            )
+            mask.append(
+                [0] * (past_length - cached)
+                + [1] * cached
+                + [0] * (new_length - new)
+                + [1] * new
+            )
+            padding = [(0, 0)] * past.ndim
+            padding[-2] = (past_length - cached, 0)
+            pasts.append(np.pad(past, padding, mode="constant"))
+        return context, mask, np.concatenate(pasts)
+
+    def cache_outputs(self, sessions, mask, output):
+        """Caches the presents of every row without its padding."""
+        out, presents = output["tokens"], output["presents"]
+        for i, session in enumerate(sessions):
+            valid = np.ones(out.shape[1], dtype=bool)
+            valid[: len(mask[i])] = mask[i]
+            self.cache_past(
+                list(out[i][valid]),
+                np.compress(valid[: presents.shape[-2]], presents[i : i + 1], axis=-2),
+                session,
+            )
+
+    def generate_raw(self, prompt, session=None, stop=None, options=None):
+        return self.generate_raw_batch([prompt], [session], [stop], [options])[0]
+
+    def generate_candidates(self, prompt, num_candidates, options=None, session=None):
+        """Samples num_candidates results for prompt in one batched run.
+
+        The prompt is run through the model once and its keys and values are
+        tiled for every candidate, so only the decode grows with
+        num_candidates. Returns the candidates cleaned up like the result of
+        generate in the order they were sampled, empty ones are left out.
+        With a seed candidate i is sampled with seed + i.
+        """
+        prompt = self.prompt_replace(prompt)
+        options = self.sampling_options(options)
+        context, mask, past = self.batch_inputs([prompt], [session], [options])
+        tokens = context[0]
+        if past.shape[-2] < len(tokens) - 1:
+            # Sampling a single token runs the whole prompt through the model
+            output = self.engine.generate(
+                context,
+                mask,
+                past,
+                self.stop_sequences_batch([[]]),
+                [dict(options, generate_num=1)],
+            )
+            past = output["presents"][..., : len(tokens) - 1, :]
+        # Whichever candidate is picked, the next prompt starts with this one
+        self.cache_past(tokens, past, session)
+
+        output = self.engine.generate(
+            [tokens] * num_candidates,
+            mask * num_candidates,
+            np.repeat(past, num_candidates, axis=0),
+            self.stop_sequences_batch([self.stop] * num_candidates),
+            [self.candidate_options(options, i) for i in range(num_candidates)],
+            self.banned_sequences_batch(num_candidates),
+            self.word_breaks,
+        )
+        out, lengths = output["tokens"], output["lengths"]
+        results = []
+        for i in range(num_candidates):
+            generated = out[i, len(tokens) : len(tokens) + lengths[i]]
+            result = self.result_replace(
+                self.cut_at_stop(self.enc.decode(generated), self.stop)
+            )
+            if len(result) > 0:
+                results.append(result)
+        return results
+
+    def generate_raw_stream(self, prompt, session=None, stop=None, options=None):
+        """Same as generate_raw, but yields the text as the tokens are sampled.
+
+        Text that could be the start of a stop string is held back until it
+        is clear whether it is one.
+        """
+        stop = self.stop if stop is None else stop
+        options = [self.sampling_options(options)]
+        context, mask, past = self.batch_inputs([prompt], [session], options)
+        steps = self.engine.generate_stream(
+            context,
+            mask,
+            past,
+            self.stop_sequences_batch([stop]),
+            options,
+            self.banned_sequences_batch(1),
+            self.word_breaks,
+        )
+
+        decoder = self.enc.incremental_decoder()
+        text = ""
+        sent = 0
+        while True:
+            try:
+                tokens = next(steps)
+            except StopIteration as finished:
+                output = finished.value
+                break
+            text += decoder.decode(tokens[0])
+            text = self.cut_at_stop(text, stop)
+            end = len(text) - held_back(text, stop)
+            if end > sent:
+                yield text[sent:end]
+                sent = end
+        self.cache_outputs([session], mask, output)
+        text = self.cut_at_stop(text + decoder.decode([], final=True), stop)
+        if len(text) > sent:
+            yield text[sent:]
+
+    def generate(self, prompt, options=None, seed=None, session=None):
 
         debug_print = False
         prompt = self.prompt_replace(prompt)
@@ -123,7 +540,9 @@ class GPT2Generator:
             print("******DEBUG******")
             print("Prompt is: ", repr(prompt))
 
-        text = self.generate_raw(prompt)
+        if seed is not None:
+            options = dict(options or {}, seed=seed)
+        text = self.generate_raw(prompt, session=session, options=options)
 
         if debug_print:
             print("Generated result is: ", repr(text))
@@ -132,6 +551,48 @@ class GPT2Generator:
         result = text
         result = self.result_replace(result)
         if len(result) == 0:
-            return self.generate(prompt)
+            return self.generate(prompt, self.retry_options(options), session=session)
 
         return result
+
+    @staticmethod
+    def candidate_options(options, index):
+        """Options of candidate index, the same seed would give every candidate the same result."""
+        if options.get("seed") is None:
+            return options
+        return dict(options, seed=options["seed"] + index)
+
+    @staticmethod
+    def retry_options(options):
+        """Options to sample again after an empty result, which the same seed would give again."""
+        if options is None or options.get("seed") is None:
+            return options
+        return dict(options, seed=options["seed"] + 1)
+
+    def generate_stream(self, prompt, options=None, session=None):
+        """Same as generate, but yields the result a few sentences at a time while it is sampled.
+
+        Text is yielded once it ends with a finished sentence outside of
+        quotes, cleaned up like the result of generate. The rest is cut to its
+        last finished sentence at the end, so the chunks joined are the result
+        of generate.
+        """
+        prompt = self.prompt_replace(prompt)
+
+        text = ""
+        sent = 0
+        empty = True
+        for piece in self.generate_raw_stream(prompt, session=session, options=options):
+            text += standardize_punctuation(piece)
+            end = finished_sentences(text)
+            if end > sent:
+                yield self.clean_result(text[sent:end])
+                sent = end
+                empty = False
+        end = len(cut_trailing_sentence(text))
+        if end > sent:
+            yield self.clean_result(text[sent:end])
+        elif empty:
+            yield from self.generate_stream(
+                prompt, self.retry_options(options), session=session
+            )
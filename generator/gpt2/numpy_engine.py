@@ -0,0 +1,149 @@
+import json
+import os
+
+import numpy as np
+
+from generator.gpt2.src import checkpoint, numpy_model, numpy_sample, quantize as quantization, weights
+
+
+def load_model(checkpoint_dir, quantize=None):
+    """Returns the hparams and the weights (a name -> array mapping) of checkpoint_dir.
+
+    Quantized weights are expanded to float32 here, see quantize.py.
+    """
+    hparams = numpy_model.default_hparams()
+    with open(os.path.join(checkpoint_dir, "hparams.json")) as f:
+        hparams.override_from_dict(json.load(f))
+
+    params = weights.open_store(checkpoint_dir, quantize)
+    if params is None:
+        params = weights.open_store(checkpoint_dir)
+        if params is None:
+            reader = checkpoint.CheckpointReader(
+                checkpoint.latest_checkpoint(checkpoint_dir)
+            )
+            params = {
+                name: reader.get_tensor(name)
+                for name in reader.names()
+                if name.startswith("model/")
+            }
+        if quantize is not None:
+            # Not converted yet, quantize the float32 weights in memory
+            params = quantization.quantize_params(params, quantize)
+    if quantize is not None:
+        params = quantization.dequantize_params(params)
+    return hparams, params
+
+
+class NumpyEngine:
+    """Same interface as TFEngine, but runs the model in plain NumPy.
+
+    The weights are mapped from the converted weight file (see
+    convert_weights.py), or read straight from the TensorFlow checkpoint if
+    there is none, so tensorflow is never imported. quantize ("int8" or
+    "float16") picks the quantized weight file instead, or quantizes the
+    float32 weights in memory if it was not converted. Either way they are
+    expanded back to float32 when they are loaded.
+
+    With draft_dir a smaller model of the same vocabulary proposes
+    draft_tokens tokens at a time, which the model checks in one call (see
+    numpy_sample.speculative_sequence).
+    """
+
+    def __init__(
+        self, checkpoint_dir, quantize=None, prefill_chunk=None, draft_dir=None, draft_tokens=4
+    ):
+        self.hparams, self.params = load_model(checkpoint_dir, quantize)
+        self.prefill_chunk = prefill_chunk
+
+        self.draft_tokens = draft_tokens
+        self.draft_hparams = self.draft_params = None
+        if draft_dir is not None:
+            self.draft_hparams, self.draft_params = load_model(draft_dir, quantize)
+            if self.draft_hparams.n_vocab != self.hparams.n_vocab:
+                raise ValueError("%s does not share the vocabulary of the model" % draft_dir)
+        # Draft tokens proposed and accepted so far
+        self.proposed = 0
+        self.accepted = 0
+
+    @property
+    def acceptance_rate(self):
+        return self.accepted / max(self.proposed, 1)
+
+    def past_shape(self, batch_size=None, sequence=None):
+        return numpy_model.past_shape(
+            hparams=self.hparams, batch_size=batch_size, sequence=sequence
+        )
+
+    def generate(
+        self,
+        context,
+        mask,
+        past,
+        stop_sequences,
+        options,
+        banned_sequences=None,
+        word_breaks=None,
+    ):
+        """Returns the tokens, presents and lengths of sample_sequence, options has one dict per row."""
+        return numpy_sample.drain(
+            self.generate_stream(
+                context, mask, past, stop_sequences, options, banned_sequences, word_breaks
+            )
+        )
+
+    def generate_stream(
+        self,
+        context,
+        mask,
+        past,
+        stop_sequences,
+        options,
+        banned_sequences=None,
+        word_breaks=None,
+    ):
+        """Same as generate, but yields the [batch, n] new tokens as they are sampled.
+
+        The output of generate is the return value of the generator.
+        """
+
+        def option(key, dtype):
+            return np.array([o[key] for o in options], dtype=dtype)
+
+        kwargs = {}
+        sample_steps = numpy_sample.sample_steps
+        if self.draft_params is not None:
+            sample_steps = numpy_sample.speculative_steps
+            kwargs = dict(
+                draft_hparams=self.draft_hparams,
+                draft_params=self.draft_params,
+                draft_tokens=self.draft_tokens,
+            )
+        output = yield from sample_steps(
+            hparams=self.hparams,
+            params=self.params,
+            length=option("generate_num", np.int32),
+            context=np.asarray(context, dtype=np.int32),
+            past=past,
+            mask=np.asarray(mask, dtype=np.float32),
+            stop_sequences=stop_sequences,
+            banned_sequences=banned_sequences,
+            word_breaks=word_breaks,
+            prefill_chunk=self.prefill_chunk,
+            temperature=option("temperature", np.float32),
+            top_k=option("top_k", np.int32),
+            top_p=option("top_p", np.float32),
+            repetition_penalty=option("repetition_penalty", np.float32),
+            presence_penalty=option("presence_penalty", np.float32),
+            frequency_penalty=option("frequency_penalty", np.float32),
+            penalty_window=option("penalty_window", np.int32),
+            # None draws random tokens
+            seed=np.array(
+                [-1 if o.get("seed") is None else o["seed"] for o in options],
+                dtype=np.int64,
+            ),
+            **kwargs
+        )
+        self.proposed += output.pop("proposed", 0)
+        self.accepted += output.pop("accepted", 0)
+        return output
@@ -0,0 +1,104 @@
+import hashlib
+import json
+import os
+import tempfile
+from collections import OrderedDict
+
+
+class ResultCache:
+    """LRU cache of generated texts, keyed by everything that determines a seeded generation.
+
+    Up to max_entries results are kept in memory. With directory every
+    result is also written there as one file, and the least recently used
+    files are deleted once they take more than max_bytes, so the cache
+    survives restarts and can be shared by several processes. Every process
+    finds the files of the others, but only counts the ones it has seen
+    towards max_bytes.
+    """
+
+    def __init__(self, directory=None, max_entries=1024, max_bytes=64 * 2 ** 20):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.memory = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+        # key -> file size, least recently used first
+        self.files = OrderedDict()
+        self.size = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            entries = []
+            for name in os.listdir(directory):
+                if name.endswith(".json"):
+                    stat = os.stat(os.path.join(directory, name))
+                    entries.append((stat.st_mtime, name[: -len(".json")], stat.st_size))
+            for _, key, size in sorted(entries):
+                self.files[key] = size
+                self.size += size
+
+    @staticmethod
+    def key(**parts):
+        """Hash of parts, which have to be serializable to JSON."""
+        data = json.dumps(parts, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".json")
+
+    def get(self, key):
+        """Returns the text stored for key, None if there is none."""
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.hits += 1
+            return self.memory[key]
+        # Files not in the index were written by other processes
+        if self.directory is not None and (
+            key in self.files or os.path.exists(self.path(key))
+        ):
+            try:
+                with open(self.path(key), "r", encoding="utf-8") as f:
+                    text = json.load(f)["text"]
+                # The modification time orders the files for eviction
+                os.utime(self.path(key))
+                size = os.path.getsize(self.path(key))
+            except (OSError, ValueError, KeyError):
+                # Evicted by another process
+                self.size -= self.files.pop(key, 0)
+            else:
+                self.size += size - self.files.pop(key, 0)
+                self.files[key] = size
+                self.remember(key, text)
+                self.hits += 1
+                return text
+        self.misses += 1
+        return None
+
+    def put(self, key, text):
+        self.remember(key, text)
+        if self.directory is None:
+            return
+
+        path = self.path(key)
+        # Other processes can write the same key at the same time
+        fd, temporary = tempfile.mkstemp(dir=self.directory, prefix=key, suffix=".tmp")
+        with open(fd, "w", encoding="utf-8") as f:
+            json.dump({"text": text}, f)
+        os.replace(temporary, path)
+        self.size -= self.files.pop(key, 0)
+        self.files[key] = os.path.getsize(path)
+        self.size += self.files[key]
+        while self.size > self.max_bytes and len(self.files) > 1:
+            old, size = self.files.popitem(last=False)
+            self.size -= size
+            try:
+                os.remove(self.path(old))
+            except OSError:
+                pass
+
+    def remember(self, key, text):
+        self.memory[key] = text
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
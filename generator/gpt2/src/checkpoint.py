@@ -0,0 +1,166 @@
+"""Reads TensorFlow checkpoints (tensor bundles) without importing tensorflow.
+
+A checkpoint is an index file, a LevelDB style table mapping every variable
+name to a serialized BundleEntryProto, and data files holding the raw
+little-endian tensor bytes the entries point into.
+"""
+
+import os
+import re
+import struct
+
+import numpy as np
+
+TABLE_MAGIC = 0xDB4775248B80FB57
+
+# DataType values from tensorflow/core/framework/types.proto
+DTYPES = {
+    1: np.float32,
+    2: np.float64,
+    3: np.int32,
+    4: np.uint8,
+    5: np.int16,
+    6: np.int8,
+    9: np.int64,
+    10: np.bool_,
+    17: np.uint16,
+    19: np.float16,
+}
+
+
+def latest_checkpoint(checkpoint_dir):
+    """Returns the checkpoint prefix named in checkpoint_dir/checkpoint, like tf.train.latest_checkpoint."""
+    with open(os.path.join(checkpoint_dir, "checkpoint"), "r") as f:
+        match = re.search(r'^model_checkpoint_path:\s*"(.*)"', f.read(), re.MULTILINE)
+    if match is None:
+        return None
+    path = match.group(1)
+    if not os.path.isabs(path):
+        path = os.path.join(checkpoint_dir, path)
+    return path
+
+
+def read_varint(data, pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def parse_proto(data):
+    """Splits a serialized protocol buffer message into {field number: [values]}."""
+    fields = {}
+    pos = 0
+    while pos < len(data):
+        key, pos = read_varint(data, pos)
+        number, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, pos = read_varint(data, pos)
+        elif wire_type == 1:
+            value = data[pos : pos + 8]
+            pos += 8
+        elif wire_type == 2:
+            length, pos = read_varint(data, pos)
+            value = data[pos : pos + length]
+            pos += length
+        elif wire_type == 5:
+            value = data[pos : pos + 4]
+            pos += 4
+        else:
+            raise ValueError("Unsupported protobuf wire type %d" % wire_type)
+        fields.setdefault(number, []).append(value)
+    return fields
+
+
+def read_handle(data, pos=0):
+    offset, pos = read_varint(data, pos)
+    size, pos = read_varint(data, pos)
+    return (offset, size), pos
+
+
+def read_block(f, handle):
+    offset, size = handle
+    f.seek(offset)
+    # Every block is followed by a compression type byte and a checksum
+    data = f.read(size + 5)
+    if data[size] != 0:
+        raise ValueError("Compressed checkpoint index blocks are not supported")
+    return data[:size]
+
+
+def block_entries(block):
+    num_restarts = struct.unpack("<I", block[-4:])[0]
+    end = len(block) - 4 * (num_restarts + 1)
+    pos = 0
+    key = b""
+    while pos < end:
+        shared, pos = read_varint(block, pos)
+        non_shared, pos = read_varint(block, pos)
+        value_length, pos = read_varint(block, pos)
+        key = key[:shared] + block[pos : pos + non_shared]
+        pos += non_shared
+        yield key, block[pos : pos + value_length]
+        pos += value_length
+
+
+class CheckpointReader:
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.num_shards = 1
+        # name -> (dtype, shape, shard_id, offset, size)
+        self.entries = {}
+
+        with open(prefix + ".index", "rb") as f:
+            f.seek(-48, os.SEEK_END)
+            footer = f.read(48)
+            if struct.unpack("<Q", footer[40:])[0] != TABLE_MAGIC:
+                raise ValueError("%s.index is not a checkpoint index" % prefix)
+            _, pos = read_handle(footer)
+            index_handle, _ = read_handle(footer, pos)
+
+            for _, value in block_entries(read_block(f, index_handle)):
+                block = read_block(f, read_handle(value)[0])
+                for key, entry in block_entries(block):
+                    self.add_entry(key.decode("utf-8"), parse_proto(entry))
+
+    def add_entry(self, name, fields):
+        if name == "":
+            # The header entry
+            self.num_shards = fields.get(1, [1])[0]
+            return
+        dtype = fields.get(1, [0])[0]
+        if dtype not in DTYPES:
+            # Strings and other types are never needed for inference
+            return
+        shape = []
+        if 2 in fields:
+            for dim in parse_proto(fields[2][0]).get(2, []):
+                shape.append(parse_proto(dim).get(1, [0])[0])
+        self.entries[name] = (
+            np.dtype(DTYPES[dtype]).newbyteorder("<"),
+            tuple(shape),
+            fields.get(3, [0])[0],
+            fields.get(4, [0])[0],
+            fields.get(5, [0])[0],
+        )
+
+    def names(self):
+        return sorted(self.entries)
+
+    def data_path(self, shard_id):
+        return "%s.data-%05d-of-%05d" % (self.prefix, shard_id, self.num_shards)
+
+    def get_tensor(self, name, mmap=True):
+        """Returns the tensor stored under name, mapped from the data file unless mmap is False."""
+        dtype, shape, shard_id, offset, size = self.entries[name]
+        path = self.data_path(shard_id)
+        if mmap and len(shape) > 0 and size > 0:
+            return np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=shape)
+        with open(path, "rb") as f:
+            f.seek(offset)
+            return np.frombuffer(f.read(size), dtype=dtype).reshape(shape)
@@ -1,11 +1,28 @@
 """Byte pair encoding utilities"""
 
+import codecs
+import collections
+import hashlib
+import heapq
+import itertools
 import json
+import multiprocessing
 import os
 from functools import lru_cache
 
+import numpy as np
 import regex as re
 
+# Most common pre-tokens of the story corpus, written by count_pretokens.py
+COMMON_PRETOKENS = "common_pretokens.txt"
+# Pre-tokens an Encoder keeps merged by default
+CACHE_SIZE = 2 ** 16
+# encoder.json and vocab.bpe as arrays, written by compile_vocab.py
+COMPILED_VOCAB = "vocab.npz"
+COMPILED_VOCAB_VERSION = 1
+# Ends a document in the corpora of data/build_training_data.py and data/make_reddit_data.py
+END_OF_TEXT = "<|endoftext|>"
+
 
 @lru_cache()
 def bytes_to_unicode():
@@ -47,15 +64,115 @@ def get_pairs(word):
     return pairs
 
 
+def merge_symbols(word, bpe_ranks):
+    """Merges the symbols of word by bpe_ranks, returns the list of merged symbols.
+
+    The symbols are a doubly linked list and the pairs that can be merged
+    wait in a heap by rank and position, so a merge only looks at its two
+    neighbours instead of rescanning the word. Pairs a merge forms join the
+    heap once every occurrence of the current pair is merged, which gives
+    the same result as repeatedly merging the lowest ranked pair of the
+    whole word from left to right.
+    """
+    symbols = list(word)
+    end = len(symbols)
+    before = list(range(-1, end - 1))
+    after = list(range(1, end + 1))
+
+    heap = []
+    for i in range(end - 1):
+        rank = bpe_ranks.get((symbols[i], symbols[i + 1]))
+        if rank is not None:
+            heap.append((rank, i))
+    heapq.heapify(heap)
+
+    formed = []
+    current = None
+    while heap or formed:
+        if formed and (not heap or heap[0][0] != current):
+            for pair in formed:
+                heapq.heappush(heap, pair)
+            formed = []
+        current, i = heapq.heappop(heap)
+
+        # Skip pairs that an earlier merge took a symbol of
+        j = after[i]
+        if symbols[i] is None or j == end:
+            continue
+        if bpe_ranks.get((symbols[i], symbols[j])) != current:
+            continue
+
+        symbols[i] += symbols[j]
+        symbols[j] = None
+        after[i] = after[j]
+        if after[i] != end:
+            before[after[i]] = i
+
+        if before[i] >= 0:
+            rank = bpe_ranks.get((symbols[before[i]], symbols[i]))
+            if rank is not None:
+                formed.append((rank, before[i]))
+        if after[i] != end:
+            rank = bpe_ranks.get((symbols[i], symbols[after[i]]))
+            if rank is not None:
+                formed.append((rank, i))
+
+    return [symbol for symbol in symbols if symbol is not None]
+
+
+class TokenCache:
+    """LRU cache of the merged pre-tokens of an Encoder.
+
+    Holds at most capacity pre-tokens, so a long running process does not
+    keep every rare word and name it ever saw. hits, misses and evictions
+    count since the cache was created.
+    """
+
+    def __init__(self, capacity=CACHE_SIZE):
+        self.capacity = capacity
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, token):
+        """Returns the merged token, None if it is not cached."""
+        word = self.entries.get(token)
+        if word is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(token)
+        self.hits += 1
+        return word
+
+    def put(self, token, word):
+        self.entries[token] = word
+        self.entries.move_to_end(token)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
 class Encoder:
-    def __init__(self, encoder, bpe_merges, errors="replace"):
+    def __init__(
+        self, encoder, bpe_merges, errors="replace", cache_size=CACHE_SIZE, version=None
+    ):
         self.encoder = encoder
+        # Identifies the vocabulary, token ids are only valid for the same version
+        self.version = version
         self.decoder = {v: k for k, v in self.encoder.items()}
         self.errors = errors  # how to handle errors in decoding
         self.byte_encoder = bytes_to_unicode()
         self.byte_decoder = {v: k for k, v in self.byte_encoder.items()}
         self.bpe_ranks = dict(zip(bpe_merges, range(len(bpe_merges))))
-        self.cache = {}
+        self.cache = TokenCache(cache_size)
 
         # Should haved added re.IGNORECASE so BPE merges can happen for capitalized versions of contractions
         self.pat = re.compile(
@@ -63,50 +180,35 @@ class Encoder:
         )
 
     def bpe(self, token):
-        if token in self.cache:
-            return self.cache[token]
-        word = tuple(token)
-        pairs = get_pairs(word)
-
-        if not pairs:
+        if len(token) < 2:
             return token
-
-        while True:
-            bigram = min(pairs, key=lambda pair: self.bpe_ranks.get(pair, float("inf")))
-            if bigram not in self.bpe_ranks:
-                break
-            first, second = bigram
-            new_word = []
-            i = 0
-            while i < len(word):
-                try:
-                    j = word.index(first, i)
-                    new_word.extend(word[i:j])
-                    i = j
-                except:
-                    new_word.extend(word[i:])
-                    break
-
-                if word[i] == first and i < len(word) - 1 and word[i + 1] == second:
-                    new_word.append(first + second)
-                    i += 2
-                else:
-                    new_word.append(word[i])
-                    i += 1
-            new_word = tuple(new_word)
-            word = new_word
-            if len(word) == 1:
-                break
-            else:
-                pairs = get_pairs(word)
-        word = " ".join(word)
-        self.cache[token] = word
+        word = self.cache.get(token)
+        if word is None:
+            word = " ".join(merge_symbols(token, self.bpe_ranks))
+            self.cache.put(token, word)
         return word
 
+    def warm(self, merges):
+        """Caches (pre-token, merged) pairs, the most common first, as many as fit.
+
+        Pre-tokens without their merged form (None) are merged here.
+        """
+        merges = list(itertools.islice(merges, self.cache.capacity))
+        # The most common are added last, they are the last to be evicted
+        for token, merged in reversed(merges):
+            if len(token) > 1:
+                if merged is None:
+                    merged = " ".join(merge_symbols(token, self.bpe_ranks))
+                self.cache.put(token, merged)
+
+    def pretokens(self, text):
+        """The pieces of text that are merged separately, as byte encoded strings."""
+        for token in re.findall(self.pat, text):
+            yield "".join(self.byte_encoder[b] for b in token.encode("utf-8"))
+
     def encode(self, text):
         bpe_tokens = []
-        for token in re.findall(self.pat, text):
-            token = "".join(self.byte_encoder[b] for b in token.encode("utf-8"))
+        for token in self.pretokens(text):
             bpe_tokens.extend(
                 self.encoder[bpe_token] for bpe_token in self.bpe(token).split(" ")
             )
@@ -119,13 +221,269 @@ class Encoder:
         )
         return text
 
+    def incremental_decoder(self):
+        return IncrementalDecoder(self)
+
+    def pool(self, processes):
+        """Returns a process pool whose workers encode and decode with a copy of this encoder."""
+        # Spawned, forking a process that loaded tensorflow is not safe
+        context = multiprocessing.get_context("spawn")
+        return context.Pool(processes, initializer=_init_worker, initargs=(self,))
+
+    def encode_batch(self, texts, processes=1):
+        """Encodes every text, spread over processes workers if there is more than one.
+
+        The ids are returned in the order of texts. Starting the workers
+        takes a moment, more processes only pay off for many or long texts.
+        """
+        texts = list(texts)
+        if processes <= 1:
+            return [self.encode(text) for text in texts]
+        with self.pool(processes) as pool:
+            return pool.map(
+                _encode_text, texts, chunksize=max(len(texts) // (processes * 4), 1)
+            )
+
+    def decode_batch(self, token_lists, processes=1):
+        """Decodes every list of ids, like encode_batch."""
+        token_lists = [list(tokens) for tokens in token_lists]
+        if processes <= 1:
+            return [self.decode(tokens) for tokens in token_lists]
+        with self.pool(processes) as pool:
+            return pool.map(
+                _decode_tokens,
+                token_lists,
+                chunksize=max(len(token_lists) // (processes * 4), 1),
+            )
+
+    def encode_file(
+        self, path, output, processes=1, separator=END_OF_TEXT, documents_per_task=64
+    ):
+        """Encodes the corpus at path into output and returns them like load_tokens.
+
+        A document ends with a line that ends with separator, with separator
+        None every line is a document. The ids of all documents are written in
+        order as uint16 to output, the ids of document i are
+        tokens[offsets[i] : offsets[i + 1]] and the offsets are saved as
+        output + ".offsets.npy". The file is read as the workers are ready
+        for more, so it does not have to fit in memory.
+        """
+        if len(self.encoder) > 2 ** 16:
+            raise ValueError("uint16 cannot hold the %d token ids" % len(self.encoder))
 
-def get_encoder(model_name, models_dir):
-    with open(os.path.join(models_dir, model_name, "encoder.json"), "r") as f:
-        encoder = json.load(f)
-    with open(
-        os.path.join(models_dir, model_name, "vocab.bpe"), "r", encoding="utf-8"
-    ) as f:
+        # Every token covers at least one byte of the file, the rest is cut off at the end
+        capacity = max(os.path.getsize(path), 1)
+        tokens = np.memmap(output, dtype=np.uint16, mode="w+", shape=(capacity,))
+        offsets = [0]
+
+        def write(encoded):
+            for ids in encoded:
+                end = offsets[-1] + len(ids)
+                tokens[offsets[-1] : end] = ids
+                offsets.append(end)
+
+        # newline="" keeps the line endings as they are in the file
+        with open(path, "r", encoding="utf-8", newline="") as f:
+            tasks = _batches(_documents(f, separator), documents_per_task)
+            if processes <= 1:
+                for documents in tasks:
+                    write([self.encode(document) for document in documents])
+            else:
+                with self.pool(processes) as pool:
+                    pending = collections.deque()
+                    for documents in tasks:
+                        pending.append(pool.apply_async(_encode_texts, (documents,)))
+                        # A few tasks per worker keep it busy without reading ahead too far
+                        if len(pending) > 2 * processes:
+                            write(pending.popleft().get())
+                    while pending:
+                        write(pending.popleft().get())
+
+        tokens.flush()
+        del tokens
+        os.truncate(output, offsets[-1] * np.dtype(np.uint16).itemsize)
+        np.save(output + ".offsets.npy", np.array(offsets, dtype=np.int64))
+        return load_tokens(output)
+
+
+class IncrementalDecoder:
+    """Decodes tokens as they are generated.
+
+    A character can be split over several tokens, its bytes are held back
+    until it is complete, so the pieces joined are the same as decoding
+    all tokens at once.
+    """
+
+    def __init__(self, encoder):
+        self.encoder = encoder
+        self.utf8 = codecs.getincrementaldecoder("utf-8")(errors=encoder.errors)
+
+    def decode(self, tokens, final=False):
+        text = "".join([self.encoder.decoder[token] for token in tokens])
+        return self.utf8.decode(
+            bytes([self.encoder.byte_decoder[c] for c in text]), final=final
+        )
+
+
+# Copy of the encoder in a pool worker
+_worker_encoder = None
+
+
+def _init_worker(enc):
+    global _worker_encoder
+    _worker_encoder = enc
+
+
+def _encode_text(text):
+    return _worker_encoder.encode(text)
+
+
+def _encode_texts(texts):
+    return [_worker_encoder.encode(text) for text in texts]
+
+
+def _decode_tokens(tokens):
+    return _worker_encoder.decode(tokens)
+
+
+def _documents(lines, separator):
+    document = []
+    for line in lines:
+        document.append(line)
+        if separator is None or line.rstrip("\r\n").endswith(separator):
+            yield "".join(document)
+            document = []
+    if document:
+        yield "".join(document)
+
+
+def _batches(items, size):
+    items = iter(items)
+    while True:
+        batch = list(itertools.islice(items, size))
+        if not batch:
+            return
+        yield batch
+
+
+def load_tokens(path):
+    """Returns the ids written by Encoder.encode_file, memory-mapped, and the document offsets."""
+    offsets = np.load(path + ".offsets.npy")
+    if offsets[-1] == 0:
+        # An empty file cannot be mapped
+        return np.zeros(0, dtype=np.uint16), offsets
+    return np.memmap(path, dtype=np.uint16, mode="r"), offsets
+
+
+def read_sources(model_dir):
+    """Returns the contents of encoder.json and vocab.bpe and their checksum."""
+    with open(os.path.join(model_dir, "encoder.json"), "rb") as f:
+        encoder_data = f.read()
+    with open(os.path.join(model_dir, "vocab.bpe"), "rb") as f:
         bpe_data = f.read()
-    bpe_merges = [tuple(merge_str.split()) for merge_str in bpe_data.split("\n")[1:-1]]
-    return Encoder(encoder=encoder, bpe_merges=bpe_merges,)
+    checksum = hashlib.sha256(encoder_data + bpe_data).hexdigest()
+    return encoder_data, bpe_data, checksum
+
+
+def parse_sources(encoder_data, bpe_data):
+    encoder = json.loads(encoder_data.decode("utf-8"))
+    bpe_merges = [
+        tuple(merge_str.split()) for merge_str in bpe_data.decode("utf-8").split("\n")[1:-1]
+    ]
+    return encoder, bpe_merges
+
+
+def compile_vocab(model_dir):
+    """Writes the vocabulary and merges of model_dir as arrays that load faster than the JSON.
+
+    Tokens are stored as one newline separated string and merges as the ids
+    of their two halves, so the file only holds vocabularies whose tokens
+    have no newline and whose merges are made of tokens, like GPT-2's.
+    """
+    encoder_data, bpe_data, checksum = read_sources(model_dir)
+    encoder, bpe_merges = parse_sources(encoder_data, bpe_data)
+    words = sorted(encoder, key=encoder.get)
+    if any("\n" in word for word in words):
+        raise ValueError("A token contains a newline")
+    if any(first not in encoder or second not in encoder for first, second in bpe_merges):
+        raise ValueError("A merge is not made of two tokens")
+
+    path = os.path.join(model_dir, COMPILED_VOCAB)
+    with open(path + ".tmp", "wb") as f:
+        np.savez(
+            f,
+            version=np.array(COMPILED_VOCAB_VERSION),
+            checksum=np.array(checksum),
+            words=np.frombuffer("\n".join(words).encode("utf-8"), dtype=np.uint8),
+            ids=np.array([encoder[word] for word in words], dtype=np.int32),
+            merges=np.array(
+                [[encoder[first], encoder[second]] for first, second in bpe_merges],
+                dtype=np.int32,
+            ).reshape(-1, 2),
+        )
+    os.replace(path + ".tmp", path)
+    return path
+
+
+def load_compiled_vocab(model_dir, checksum):
+    """Returns the vocabulary and merges of compile_vocab, None if there are none for these sources."""
+    path = os.path.join(model_dir, COMPILED_VOCAB)
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as arrays:
+        if int(arrays["version"]) != COMPILED_VOCAB_VERSION:
+            return None
+        if str(arrays["checksum"]) != checksum:
+            # Compiled from other sources
+            return None
+        words = arrays["words"].tobytes().decode("utf-8").split("\n")
+        ids = arrays["ids"].tolist()
+        merges = arrays["merges"]
+        first = merges[:, 0].tolist()
+        second = merges[:, 1].tolist()
+
+    encoder = dict(zip(words, ids))
+    decoder = dict(zip(ids, words))
+    bpe_merges = list(zip(map(decoder.__getitem__, first), map(decoder.__getitem__, second)))
+    return encoder, bpe_merges
+
+
+def get_encoder(model_name, models_dir, cache_size=CACHE_SIZE):
+    """Loads the encoder of a model, its cache warmed with the common pre-tokens if there are any.
+
+    The vocabulary comes from the compiled vocab.npz if it was compiled
+    from the current encoder.json and vocab.bpe, otherwise from those.
+    """
+    model_dir = os.path.join(models_dir, model_name)
+    encoder_data, bpe_data, checksum = read_sources(model_dir)
+    vocab = load_compiled_vocab(model_dir, checksum)
+    if vocab is None:
+        vocab = parse_sources(encoder_data, bpe_data)
+    encoder, bpe_merges = vocab
+    enc = Encoder(
+        encoder=encoder, bpe_merges=bpe_merges, cache_size=cache_size, version=checksum[:16]
+    )
+    common = os.path.join(model_dir, COMMON_PRETOKENS)
+    if os.path.exists(common):
+        with open(common, "r", encoding="utf-8") as f:
+            enc.warm(read_common_pretokens(f, enc.version))
+    return enc
+
+
+def write_common_pretokens(f, enc, tokens):
+    """Writes the version of enc, then every pre-token and its merged form tab separated."""
+    f.write("version %s\n" % enc.version)
+    for token in tokens:
+        f.write("%s\t%s\n" % (token, enc.bpe(token)))
+
+
+def read_common_pretokens(f, version):
+    """Yields the (pre-token, merged) pairs of write_common_pretokens.
+
+    The merged forms are only used if they were written for version, for
+    other vocabularies they are None and have to be merged again.
+    """
+    same_vocab = f.readline().rstrip("\n") == "version %s" % version
+    for line in f:
+        token, merged = line.rstrip("\n").split("\t")
+        yield token, merged if same_vocab else None
@@ -77,13 +77,47 @@ def attention_mask(nd, ns, *, dtype):
     return tf.cast(m, dtype)
 
 
-def attn(x, scope, n_state, *, past, hparams):
+def cache_shape(*, hparams, batch_size=None, capacity=None):
+    return [
+        2,
+        batch_size,
+        hparams.n_head,
+        capacity,
+        hparams.n_embd // hparams.n_head,
+    ]
+
+
+def write_cache(cache, present, start):
+    """Write present ([batch, 2, heads, sequence, features]) into cache at position start.
+
+    cache is a preallocated [2, batch, heads, capacity, features] buffer of one
+    layer. tensor_scatter_nd_update updates its memory in place when the old
+    value is not used anymore, so the cache is not copied every step.
+    """
+    present = tf.transpose(present, [1, 0, 2, 3, 4])
+    two, batch, heads, sequence, _ = shape_list(present)
+    indices = tf.stack(
+        tf.meshgrid(
+            tf.range(two),
+            tf.range(batch),
+            tf.range(heads),
+            start + tf.range(sequence),
+            indexing="ij",
+        ),
+        axis=-1,
+    )
+    return tf.tensor_scatter_nd_update(cache, indices, present)
+
+
+def attn(x, scope, n_state, *, past, hparams, mask=None, cache=None, cache_length=None):
     assert x.shape.ndims == 3  # Should be [batch, sequence, features]
     assert n_state % hparams.n_head == 0
     if past is not None:
         assert (
             past.shape.ndims == 5
         )  # Should be [batch, 2, heads, sequence, features], where 2 is [k, v]
+    if cache is not None:
+        assert cache.shape.ndims == 5  # Should be [2, batch, heads, capacity, features]
 
     def split_heads(x):
         # From [batch, sequence, features] to [batch, heads, sequence, features]
@@ -96,8 +130,25 @@ def attn(x, scope, n_state, *, past, hparams):
     def mask_attn_weights(w):
         # w has shape [batch, heads, dst_sequence, src_sequence], where information flows from src to dst.
         _, _, nd, ns = shape_list(w)
-        b = attention_mask(nd, ns, dtype=w.dtype)
+        if nd == 1 and cache is None:
+            # A single new token sees everything before it, only padding is masked
+            if mask is None:
+                return w
+            b = tf.cast(mask[:, tf.newaxis, tf.newaxis, :], w.dtype)
+            return w * b - tf.cast(1e10, w.dtype) * (1 - b)
+        if cache is None:
+            b = attention_mask(nd, ns, dtype=w.dtype)
+        else:
+            # Slots of the cache after the current token have not been written yet
+            b = tf.cast(
+                tf.range(ns)[tf.newaxis, :]
+                <= cache_length + tf.range(nd)[:, tf.newaxis],
+                w.dtype,
+            )
         b = tf.reshape(b, [1, 1, nd, ns])
+        if mask is not None:
+            # mask has shape [batch, src_sequence], padding is never attended to
+            b = b * tf.cast(mask[:, tf.newaxis, tf.newaxis, :], w.dtype)
         w = w * b - tf.cast(1e10, w.dtype) * (1 - b)
         return w
 
@@ -119,6 +170,10 @@ def attn(x, scope, n_state, *, past, hparams):
             pk, pv = tf.unstack(past, axis=1)
             k = tf.concat([pk, k], axis=-2)
             v = tf.concat([pv, v], axis=-2)
+        if cache is not None:
+            # The updated cache takes the place of present
+            present = write_cache(cache, present, cache_length)
+            k, v = tf.unstack(present, axis=0)
         a = multihead_attn(q, k, v)
         a = merge_heads(a)
         a = conv1d(a, "c_proj", n_state)
@@ -133,10 +188,19 @@ def mlp(x, scope, n_state, *, hparams):
         return h2
 
 
-def block(x, scope, *, past, hparams):
+def block(x, scope, *, past, hparams, mask=None, cache=None, cache_length=None):
     with tf.variable_scope(scope):
         nx = x.shape[-1].value
-        a, present = attn(norm(x, "ln_1"), "attn", nx, past=past, hparams=hparams)
+        a, present = attn(
+            norm(x, "ln_1"),
+            "attn",
+            nx,
+            past=past,
+            hparams=hparams,
+            mask=mask,
+            cache=cache,
+            cache_length=cache_length,
+        )
         x = x + a
         m = mlp(norm(x, "ln_2"), "mlp", nx * 4, hparams=hparams)
         x = x + m
@@ -161,13 +225,38 @@ def expand_tile(value, size):
     return tf.tile(tf.expand_dims(value, axis=0), [size] + [1] * ndims)
 
 
-def positions_for(tokens, past_length):
+def positions_for(tokens, past_length, mask=None):
     batch_size = tf.shape(tokens)[0]
     nsteps = tf.shape(tokens)[1]
-    return expand_tile(past_length + tf.range(nsteps), batch_size)
-
-
-def model(hparams, X, past=None, scope="model", reuse=False):
+    positions = expand_tile(past_length + tf.range(nsteps), batch_size)
+    if mask is None:
+        return positions
+    # Padding always comes before the real tokens of a row, so it only shifts them back
+    padding = tf.shape(mask)[1] - tf.reduce_sum(tf.cast(mask, tf.int32), axis=1)
+    return tf.maximum(positions - padding[:, tf.newaxis], 0)
+
+
+def model(
+    hparams,
+    X,
+    past=None,
+    scope="model",
+    reuse=False,
+    mask=None,
+    cache=None,
+    cache_length=None,
+    positions=None,
+):
+    """mask is an optional [batch, past + sequence] tensor with 0 for left padding.
+
+    Instead of past, cache can hold one preallocated buffer per layer (see
+    cache_shape) of which the first cache_length positions are filled. X is
+    written after them and the updated buffers are returned as "cache". The
+    mask then covers the whole capacity with 1 for slots not written yet.
+
+    positions ([batch, sequence]) skips working them out from past and mask,
+    decoding keeps them in the loop instead.
+    """
     with tf.variable_scope(scope, reuse=reuse):
         results = {}
         batch, sequence = shape_list(X)
@@ -183,18 +272,35 @@ def model(hparams, X, past=None, scope="model", reuse=False):
             initializer=tf.random_normal_initializer(stddev=0.02),
         )
         past_length = 0 if past is None else tf.shape(past)[-2]
-        h = tf.gather(wte, X) + tf.gather(wpe, positions_for(X, past_length))
+        if cache is not None:
+            past_length = cache_length
+        if positions is None:
+            positions = positions_for(X, past_length, mask)
+        h = tf.gather(wte, X) + tf.gather(wpe, positions)
 
         # Transformer
         presents = []
         pasts = (
             tf.unstack(past, axis=1) if past is not None else [None] * hparams.n_layer
         )
+        caches = cache if cache is not None else [None] * hparams.n_layer
         assert len(pasts) == hparams.n_layer
-        for layer, past in enumerate(pasts):
-            h, present = block(h, "h%d" % layer, past=past, hparams=hparams)
+        assert len(caches) == hparams.n_layer
+        for layer, (past, cache) in enumerate(zip(pasts, caches)):
+            h, present = block(
+                h,
+                "h%d" % layer,
+                past=past,
+                hparams=hparams,
+                mask=mask,
+                cache=cache,
+                cache_length=cache_length,
+            )
             presents.append(present)
-        results["present"] = tf.stack(presents, axis=1)
+        if caches[0] is not None:
+            results["cache"] = presents
+        else:
+            results["present"] = tf.stack(presents, axis=1)
         h = norm(h, "ln_f")
 
         # Language model loss.  Do tokens <n predict token n?
@@ -0,0 +1,161 @@
+"""GPT-2 inference in plain NumPy, mirrors model.py.
+
+Weights are looked up by their checkpoint names in params (a dict of
+arrays). Keys and values live in one preallocated cache that every call
+writes into in place.
+"""
+
+import numpy as np
+
+
+class HParams:
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+    def override_from_dict(self, values):
+        self.__dict__.update(values)
+        return self
+
+
+def default_hparams():
+    return HParams(n_vocab=0, n_ctx=1024, n_embd=768, n_head=12, n_layer=12,)
+
+
+def softmax(x, axis=-1):
+    x = x - np.max(x, axis=axis, keepdims=True)
+    ex = np.exp(x)
+    return ex / np.sum(ex, axis=axis, keepdims=True)
+
+
+def gelu(x):
+    c = np.float32(np.sqrt(2 / np.pi))
+    return 0.5 * x * (1 + np.tanh(c * (x + 0.044715 * x * x * x)))
+
+
+def norm(x, g, b, *, axis=-1, epsilon=1e-5):
+    """Normalize to mean = 0, std = 1, then do a diagonal affine transform."""
+    u = np.mean(x, axis=axis, keepdims=True)
+    s = np.mean(np.square(x - u), axis=axis, keepdims=True)
+    x = (x - u) / np.sqrt(s + epsilon)
+    return x * g + b
+
+
+def conv1d(x, w, b):
+    *start, nx = x.shape
+    w = w.reshape(nx, -1)
+    return (np.dot(x.reshape(-1, nx), w) + b).reshape(start + [w.shape[-1]])
+
+
+def past_shape(*, hparams, batch_size=None, sequence=None):
+    return [
+        batch_size,
+        hparams.n_layer,
+        2,
+        hparams.n_head,
+        sequence,
+        hparams.n_embd // hparams.n_head,
+    ]
+
+
+def cache_shape(*, hparams, batch_size, capacity):
+    return [
+        hparams.n_layer,
+        2,
+        batch_size,
+        hparams.n_head,
+        capacity,
+        hparams.n_embd // hparams.n_head,
+    ]
+
+
+def attn(x, params, scope, *, cache, cache_length, mask, hparams):
+    """cache is the [2, batch, heads, capacity, features] buffer of this layer."""
+    batch, sequence, n_state = x.shape
+    n_head = hparams.n_head
+
+    def split_heads(x):
+        # From [batch, sequence, features] to [batch, heads, sequence, features]
+        return x.reshape(batch, sequence, n_head, -1).transpose(0, 2, 1, 3)
+
+    def merge_heads(x):
+        # Reverse of split_heads
+        return x.transpose(0, 2, 1, 3).reshape(batch, sequence, n_state)
+
+    c = conv1d(x, params[scope + "/c_attn/w"], params[scope + "/c_attn/b"])
+    q, k, v = map(split_heads, np.split(c, 3, axis=2))
+
+    end = cache_length + sequence
+    cache[0, :, :, cache_length:end] = k
+    cache[1, :, :, cache_length:end] = v
+    k = cache[0, :, :, :end]
+    v = cache[1, :, :, :end]
+
+    w = np.matmul(q, k.transpose(0, 1, 3, 2)) * np.float32(1 / np.sqrt(v.shape[-1]))
+    # w has shape [batch, heads, dst_sequence, src_sequence]
+    b = np.ones([1, 1, sequence, end], dtype=bool)
+    if sequence > 1:
+        b = b & (np.arange(end)[None, :] <= cache_length + np.arange(sequence)[:, None])
+    if mask is not None:
+        # Padding is never attended to
+        b = b & (mask[:, None, None, :end] > 0)
+    w = np.where(b, w, np.float32(-1e10))
+    a = np.matmul(softmax(w), v)
+
+    a = merge_heads(a)
+    return conv1d(a, params[scope + "/c_proj/w"], params[scope + "/c_proj/b"])
+
+
+def mlp(x, params, scope):
+    h = gelu(conv1d(x, params[scope + "/c_fc/w"], params[scope + "/c_fc/b"]))
+    return conv1d(h, params[scope + "/c_proj/w"], params[scope + "/c_proj/b"])
+
+
+def block(x, params, scope, *, cache, cache_length, mask, hparams):
+    a = attn(
+        norm(x, params[scope + "/ln_1/g"], params[scope + "/ln_1/b"]),
+        params,
+        scope + "/attn",
+        cache=cache,
+        cache_length=cache_length,
+        mask=mask,
+        hparams=hparams,
+    )
+    x = x + a
+    m = mlp(norm(x, params[scope + "/ln_2/g"], params[scope + "/ln_2/b"]), params, scope + "/mlp")
+    return x + m
+
+
+def model(hparams, params, X, *, cache, cache_length, mask=None, all_logits=False, scope="model"):
+    """Runs X after the first cache_length positions of cache and returns the logits.
+
+    cache has the shape from cache_shape and is written in place. mask is an
+    optional [batch, capacity] array with 0 for left padding and 1 for real
+    and not yet written slots. Only the logits of the last position are
+    computed unless all_logits is set.
+    """
+    batch, sequence = X.shape
+    wte = params[scope + "/wte"]
+    wpe = params[scope + "/wpe"]
+
+    positions = cache_length + np.arange(sequence)[None, :]
+    if mask is not None:
+        # Padding always comes before the real tokens of a row, so it only shifts them back
+        padding = mask.shape[1] - np.sum(mask > 0, axis=1)
+        positions = np.maximum(positions - padding[:, None], 0)
+    h = wte[X] + wpe[positions]
+
+    for layer in range(hparams.n_layer):
+        h = block(
+            h,
+            params,
+            scope + "/h%d" % layer,
+            cache=cache[layer],
+            cache_length=cache_length,
+            mask=mask,
+            hparams=hparams,
+        )
+    if not all_logits:
+        h = h[:, -1:]
+    h = norm(h, params[scope + "/ln_f/g"], params[scope + "/ln_f/b"])
+
+    return np.dot(h, wte.T)
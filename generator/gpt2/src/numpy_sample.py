@@ -0,0 +1,528 @@
+"""Sampling for numpy_model, mirrors sample.py."""
+
+import numpy as np
+
+from generator.gpt2.src import numpy_model
+
+
+def token_counts(output, mask, n_vocab, window=0):
+    """Counts the tokens of every row of output, padding is left out.
+
+    With a window only the last window positions of a row are counted.
+    """
+    batch, length = output.shape
+    window = np.broadcast_to(np.reshape(window, [-1]), [batch])[:, np.newaxis]
+    positions = np.arange(length)[np.newaxis, :]
+    recent = np.logical_or(window <= 0, positions >= length - window)
+    weights = np.logical_and(mask > 0, recent).astype(np.int32)
+    rows = np.broadcast_to(np.arange(batch)[:, np.newaxis], output.shape)
+    counts = np.zeros([batch, n_vocab], dtype=np.int32)
+    np.add.at(counts, (rows, output), weights)
+    return counts
+
+
+def update_counts(counts, output, mask, window=0):
+    """Adds the last token of output to counts and removes the one that left the window.
+
+    counts is updated in place, mask only has to cover output without its
+    last token.
+    """
+    batch, length = output.shape
+    window = np.broadcast_to(np.reshape(window, [-1]), [batch])
+    rows = np.arange(batch)
+
+    counts[rows, output[:, -1]] += 1
+    leaving = length - window - 1
+    left = np.logical_and(window > 0, leaving >= 0)
+    left = np.logical_and(left, mask[rows, np.clip(leaving, 0, length - 2)] > 0)
+    counts[rows[left], output[rows[left], leaving[left]]] -= 1
+    return counts
+
+
+def penalize_used(
+    logits, counts, repetition_penalty=0.85, presence_penalty=0, frequency_penalty=0
+):
+    """Penalizes the tokens that have been used according to counts, see sample.penalize_used."""
+    used = counts > 0
+    repetition_penalty = np.reshape(np.asarray(repetition_penalty, logits.dtype), [-1, 1])
+    presence_penalty = np.reshape(np.asarray(presence_penalty, logits.dtype), [-1, 1])
+    frequency_penalty = np.reshape(np.asarray(frequency_penalty, logits.dtype), [-1, 1])
+
+    logits = np.where(used, logits * repetition_penalty, logits)
+    logits -= presence_penalty * used.astype(logits.dtype)
+    logits -= frequency_penalty * counts.astype(logits.dtype)
+    return logits
+
+
+def candidates(logits, k, p):
+    """Top k and nucleus (top p) filtering of every row.
+
+    Returns the ids of the k largest logits in descending order and their
+    logits, -1e10 for the ones filtered out. Only these k are sorted instead
+    of the whole vocabulary. k and p can be scalars or one value per row.
+    """
+    batch, vocab = logits.shape
+    k = np.broadcast_to(np.reshape(k, [-1]), [batch])
+    k = np.where(k > 0, k, vocab)
+    max_k = int(np.max(k))
+
+    # argpartition finds the candidates without sorting the whole vocabulary
+    if max_k < vocab:
+        indices = np.argpartition(-logits, max_k - 1, axis=-1)[:, :max_k]
+    else:
+        indices = np.broadcast_to(np.arange(vocab), [batch, vocab])
+    values = np.take_along_axis(logits, indices, axis=-1)
+    order = np.argsort(-values, axis=-1, kind="stable")
+    indices = np.take_along_axis(indices, order, axis=-1)
+    values = np.take_along_axis(values, order, axis=-1)
+    kept = np.arange(max_k)[np.newaxis, :] < k[:, np.newaxis]
+    values = np.where(kept, values, np.float32(-1e10))
+
+    cumulative_probs = np.cumsum(numpy_model.softmax(values), axis=-1)
+    p = np.reshape(np.asarray(p, cumulative_probs.dtype), [-1, 1])
+    last = np.maximum(np.sum(cumulative_probs <= p, axis=-1) - 1, 0)
+    min_values = values[np.arange(batch), last]
+    values = np.where(values < min_values[:, np.newaxis], np.float32(-1e10), values)
+    return indices, values
+
+
+def mix32(x):
+    """Integer hash of the low 32 bits of x, see sample.mix32."""
+    low = np.int64(0xFFFFFFFF)
+    x = np.asarray(x, dtype=np.int64) & low
+    x ^= x >> 16
+    x = (x * 0x7FEB352D) & low
+    x ^= x >> 15
+    x = (x * 0x2C1B3C6D) & low
+    return x ^ (x >> 16)
+
+
+def uniform(seeds, counters):
+    """One draw in [0, 1) per row, see sample.uniform."""
+    seeds = np.asarray(seeds, dtype=np.int64)
+    hashed = mix32(mix32(seeds) ^ np.asarray(counters, dtype=np.int64)) / 2 ** 32
+    random = np.random.random_sample(seeds.shape)
+    return np.where(seeds >= 0, hashed, random).astype(np.float32)
+
+
+def sample_probs(probs, draws=None):
+    """Draws one index per row of probs, which do not have to sum to 1.
+
+    draws are the uniform numbers in [0, 1) that pick them, random ones if None.
+    """
+    if draws is None:
+        draws = np.random.random_sample(probs.shape[0])
+    cumulative_probs = np.cumsum(probs, axis=-1)
+    draws = np.reshape(draws, [-1, 1]) * cumulative_probs[:, -1:]
+    return np.minimum(np.sum(cumulative_probs <= draws, axis=-1), probs.shape[1] - 1)
+
+
+def sample_logits(logits, k, p, draws=None):
+    """Draws one token per row with top k and nucleus (top p) filtering.
+
+    Same as sample.sample_logits, see candidates.
+    """
+    indices, values = candidates(logits, k, p)
+    choices = sample_probs(numpy_model.softmax(values), draws)
+    return indices[np.arange(logits.shape[0]), choices][:, np.newaxis]
+
+
+def filtered_probs(logits, k, p):
+    """The [batch, vocab] probabilities sample_logits draws from."""
+    indices, values = candidates(logits, k, p)
+    probs = np.zeros(logits.shape, dtype=np.float32)
+    np.put_along_axis(probs, indices, numpy_model.softmax(values), axis=-1)
+    return probs
+
+
+def stopped(output, stop_sequences):
+    """Returns which rows of output end with one of their stop sequences, see sample.stopped."""
+    width = stop_sequences.shape[-1]
+    tail = output[:, -width:]
+    tail = np.pad(tail, [[0, 0], [width - tail.shape[1], 0]], constant_values=-2)
+    match = np.all(
+        np.logical_or(stop_sequences == tail[:, np.newaxis, :], stop_sequences < 0),
+        axis=-1,
+    )
+    match = np.logical_and(match, stop_sequences[:, :, -1] >= 0)
+    return np.any(match, axis=-1)
+
+
+def ban_sequences(logits, output, banned_sequences, word_breaks):
+    """Masks the last token of every banned sequence that output ends with the rest of, where it starts a word.
+
+    See sample.ban_sequences.
+    """
+    prefix = banned_sequences[:, :, :-1]
+    width = banned_sequences.shape[-1]
+    # The prefixes and the token before the longest one, -2 before the start of output
+    tail = output[:, max(output.shape[1] - width, 0) :]
+    tail = np.pad(tail, [[0, 0], [width - tail.shape[1], 0]], constant_values=-2)
+    match = np.all(
+        np.logical_or(prefix == tail[:, np.newaxis, 1:], prefix < 0), axis=-1
+    )
+
+    lengths = np.sum(banned_sequences >= 0, axis=-1)
+    start = np.minimum(width - lengths, width - 1)
+    first = np.take_along_axis(banned_sequences, start[..., np.newaxis], axis=-1)[..., 0]
+    before = np.take_along_axis(tail, start, axis=1)
+    starts_word = (
+        ((word_breaks[np.maximum(first, 0)] & 1) > 0)
+        | (before == -2)
+        | ((word_breaks[np.maximum(before, 0)] & 2) > 0)
+    )
+    match = match & (lengths > 0) & starts_word
+
+    rows, sequences = np.nonzero(match)
+    logits = logits.copy()
+    logits[rows, banned_sequences[rows, sequences, -1]] = np.float32(-1e10)
+    return logits
+
+
+def prefill(hparams, params, context, past, mask, capacity, prefill_chunk=None):
+    """Allocates a cache for capacity tokens and runs the context tokens past does not cover.
+
+    mask spans the whole capacity. The tokens are fed prefill_chunk at a time
+    if set. Returns the cache and the logits of the last context token.
+    """
+    batch = context.shape[0]
+    cache = np.zeros(
+        numpy_model.cache_shape(hparams=hparams, batch_size=batch, capacity=capacity),
+        dtype=np.float32,
+    )
+    filled = 0
+    if past is not None:
+        filled = past.shape[-2]
+        cache[..., :filled, :] = past.transpose(1, 2, 0, 3, 4, 5)
+
+    tokens = context[:, filled:]
+    chunk = max(tokens.shape[1] if prefill_chunk is None else prefill_chunk, 1)
+    for start in range(0, tokens.shape[1], chunk):
+        logits = numpy_model.model(
+            hparams,
+            params,
+            tokens[:, start : start + chunk],
+            cache=cache,
+            cache_length=filled,
+            mask=mask,
+        )
+        filled += tokens[:, start : start + chunk].shape[1]
+    return cache, logits
+
+
+def sample_steps(
+    *,
+    hparams,
+    params,
+    length,
+    context,
+    past=None,
+    mask=None,
+    stop_sequences=None,
+    banned_sequences=None,
+    word_breaks=None,
+    prefill_chunk=None,
+    temperature=1,
+    top_k=0,
+    top_p=1,
+    repetition_penalty=0.85,
+    presence_penalty=0,
+    frequency_penalty=0,
+    penalty_window=0,
+    seed=-1
+):
+    """Same as sample.sample_sequence with fixed_cache, on numpy arrays.
+
+    The prompt is run through the model in one call (prefill), or in calls
+    of prefill_chunk tokens, then every step feeds only the sampled token
+    and writes its keys and values into the preallocated cache.
+
+    A generator that yields the [batch, 1] tokens of every step and returns
+    the output of sample_sequence.
+    """
+    context = np.asarray(context, dtype=np.int32)
+    batch, context_length = context.shape
+    if mask is None:
+        mask = np.ones_like(context, dtype=np.float32)
+    if stop_sequences is None:
+        stop_sequences = np.full([batch, 1, 1], -1, dtype=np.int32)
+
+    row_length = np.broadcast_to(np.reshape(length, [-1]), [batch])
+    length = int(np.max(row_length))
+    seeds = np.broadcast_to(np.reshape(seed, [-1]), [batch])
+    temperature = np.reshape(np.asarray(temperature, np.float32), [-1, 1])
+
+    # Room for every token that will be fed once, mask spans the whole capacity
+    mask = np.concatenate(
+        [np.asarray(mask, np.float32), np.ones([batch, length - 1], dtype=np.float32)],
+        axis=1,
+    )
+    # Tokens already covered by past only need to be kept for the penalty
+    cache, logits = prefill(
+        hparams, params, context, past, mask, context_length + length - 1, prefill_chunk
+    )
+    filled = context_length
+
+    done = np.zeros([batch], dtype=bool)
+    lengths = np.zeros([batch], dtype=np.int32)
+    # Running token counts for the penalty, updated once per step
+    counts = token_counts(context, mask[:, :context_length], hparams.n_vocab, window=penalty_window)
+
+    output = context
+    for _ in range(length):
+        logits = logits[:, -1, : hparams.n_vocab] / temperature
+        logits = penalize_used(
+            logits,
+            counts,
+            repetition_penalty=repetition_penalty,
+            presence_penalty=presence_penalty,
+            frequency_penalty=frequency_penalty,
+        )
+        if banned_sequences is not None:
+            logits = ban_sequences(logits, output, banned_sequences, word_breaks)
+        draws = uniform(seeds, np.sum(mask[:, : output.shape[1]] > 0, axis=1))
+        prev = sample_logits(logits, k=top_k, p=top_p, draws=draws)
+        output = np.concatenate([output, prev], axis=1)
+        yield prev
+        update_counts(counts, output, mask, window=penalty_window)
+        lengths += np.logical_not(done)
+        done = np.logical_or(done, stopped(output, stop_sequences))
+        done = np.logical_or(done, lengths >= row_length)
+        if np.all(done):
+            break
+
+        logits = numpy_model.model(
+            hparams, params, prev, cache=cache, cache_length=filled, mask=mask
+        )
+        filled += 1
+
+    # Back to the layout of past, cut to the tokens actually fed
+    presents = cache[..., :filled, :].transpose(2, 0, 1, 3, 4, 5)
+    return {
+        "tokens": output,
+        "presents": presents,
+        "lengths": lengths,
+    }
+
+
+def speculative_steps(
+    *,
+    hparams,
+    params,
+    draft_hparams,
+    draft_params,
+    draft_tokens=4,
+    length,
+    context,
+    past=None,
+    mask=None,
+    stop_sequences=None,
+    banned_sequences=None,
+    word_breaks=None,
+    prefill_chunk=None,
+    temperature=1,
+    top_k=0,
+    top_p=1,
+    repetition_penalty=0.85,
+    presence_penalty=0,
+    frequency_penalty=0,
+    penalty_window=0,
+    seed=-1
+):
+    """sample_sequence where a small draft model proposes draft_tokens tokens at a time.
+
+    The model checks all proposals in one call. Each one is accepted with
+    probability min(1, p / q), p and q being the filtered probabilities of
+    the model and the draft, and the first rejected one is replaced by a
+    sample from max(p - q, 0). If all are accepted the model adds one more
+    token. So the tokens are distributed exactly as with sample_sequence.
+    Rows advance together by the shortest accepted run, rows that accepted
+    more keep their next proposal as the extra token.
+
+    Seeded rows are reproducible too, but draw different tokens than with
+    sample_sequence. past only covers the model, the draft always runs the
+    whole context.
+    Yields the [batch, n] tokens of every round and also returns how many
+    tokens were proposed and accepted.
+    """
+    context = np.asarray(context, dtype=np.int32)
+    batch, context_length = context.shape
+    if mask is None:
+        mask = np.ones_like(context, dtype=np.float32)
+    if stop_sequences is None:
+        stop_sequences = np.full([batch, 1, 1], -1, dtype=np.int32)
+
+    row_length = np.broadcast_to(np.reshape(length, [-1]), [batch])
+    length = int(np.max(row_length))
+    seeds = np.broadcast_to(np.reshape(seed, [-1]), [batch])
+    temperature = np.reshape(np.asarray(temperature, np.float32), [-1, 1])
+    rows = np.arange(batch)
+
+    # A round feeds at most draft_tokens + 1 tokens past the last one needed
+    capacity = context_length + length + draft_tokens
+    mask = np.concatenate(
+        [
+            np.asarray(mask, np.float32),
+            np.ones([batch, capacity - context_length], dtype=np.float32),
+        ],
+        axis=1,
+    )
+    cache, logits = prefill(
+        hparams, params, context, past, mask, capacity, prefill_chunk
+    )
+    draft_cache, _ = prefill(
+        draft_hparams, draft_params, context, None, mask, capacity, prefill_chunk
+    )
+    draft_filled = context_length
+
+    def probs(logits, counts, output):
+        logits = logits[:, : hparams.n_vocab] / temperature
+        logits = penalize_used(
+            logits,
+            counts,
+            repetition_penalty=repetition_penalty,
+            presence_penalty=presence_penalty,
+            frequency_penalty=frequency_penalty,
+        )
+        if banned_sequences is not None:
+            logits = ban_sequences(logits, output, banned_sequences, word_breaks)
+        return filtered_probs(logits, top_k, top_p)
+
+    done = np.zeros([batch], dtype=bool)
+    lengths = np.zeros([batch], dtype=np.int32)
+    counts = token_counts(context, mask[:, :context_length], hparams.n_vocab, window=penalty_window)
+    output = context
+    proposed = 0
+    accepted = 0
+
+    def draws(stream, offset=0):
+        """Uniform draws for the token offset places after output.
+
+        Seeded rows use a separate stream of draws for proposals (1),
+        acceptance (2) and residual samples (3).
+        """
+        positions = np.sum(mask[:, : output.shape[1]] > 0, axis=1) + offset
+        if stream == 0:
+            return uniform(seeds, positions)
+        return uniform(
+            np.where(seeds >= 0, mix32(seeds + stream * 0x9E3779B9), -1), positions
+        )
+
+    def emit(tokens):
+        """Appends tokens to output one at a time, until every row is done."""
+        nonlocal output, done, lengths
+        for token in tokens:
+            output = np.concatenate([output, token[:, np.newaxis]], axis=1)
+            update_counts(counts, output, mask, window=penalty_window)
+            lengths += np.logical_not(done)
+            done = np.logical_or(done, stopped(output, stop_sequences))
+            done = np.logical_or(done, lengths >= row_length)
+            if np.all(done):
+                return
+
+    # The first token needs no draft, the model's prefill already predicts it
+    emit([sample_probs(probs(logits[:, -1], counts, output), draws(0))])
+    yield output[:, -1:]
+
+    while not np.all(done):
+        # Everything but the last token of output is in the model's cache
+        filled = output.shape[1] - 1
+        remaining = np.max(np.where(done, 0, row_length - lengths))
+        n = min(draft_tokens, remaining - 1)
+
+        # Counts before every proposal, the model needs them for its own probabilities
+        draft_output = output
+        draft_counts = [counts.copy()]
+        q, proposals = [], []
+        for i in range(n):
+            draft_logits = numpy_model.model(
+                draft_hparams,
+                draft_params,
+                draft_output[:, draft_filled:],
+                cache=draft_cache,
+                cache_length=draft_filled,
+                mask=mask,
+            )
+            draft_filled = draft_output.shape[1]
+            q.append(probs(draft_logits[:, -1], draft_counts[-1], draft_output))
+            proposals.append(sample_probs(q[-1], draws(1, i)))
+            draft_output = np.concatenate(
+                [draft_output, proposals[-1][:, np.newaxis]], axis=1
+            )
+            draft_counts.append(
+                update_counts(
+                    draft_counts[-1].copy(), draft_output, mask, window=penalty_window
+                )
+            )
+
+        logits = numpy_model.model(
+            hparams,
+            params,
+            draft_output[:, filled:],
+            cache=cache,
+            cache_length=filled,
+            mask=mask,
+            all_logits=True,
+        )
+        p = [
+            probs(logits[:, i], draft_counts[i], draft_output[:, : filled + 1 + i])
+            for i in range(n + 1)
+        ]
+
+        # Number of proposals every row accepted before its first rejection
+        runs = np.full([batch], n)
+        for i in range(n):
+            ratio = p[i][rows, proposals[i]] / q[i][rows, proposals[i]]
+            rejected = np.logical_and(runs == n, draws(2, i) >= ratio)
+            runs[rejected] = i
+        active = np.logical_not(done)
+        proposed += n * int(np.sum(active))
+        accepted += int(np.sum(runs[active]))
+
+        run = int(np.min(runs))
+        if run == n:
+            last = sample_probs(p[n], draws(0, n))
+        else:
+            residual = np.maximum(p[run] - q[run], 0)
+            # p == q leaves no residual, the row is never rejected then anyway
+            residual = np.where(
+                np.sum(residual, axis=-1, keepdims=True) > 0, residual, p[run]
+            )
+            last = np.where(
+                runs > run, proposals[run], sample_probs(residual, draws(3, run))
+            )
+        emitted = output.shape[1]
+        emit(proposals[:run] + [last])
+        yield output[:, emitted:]
+        # The draft cache is only valid for the accepted proposals
+        draft_filled = min(draft_filled, filled + 1 + run, output.shape[1] - 1)
+
+    # Back to the layout of past, cut to the tokens actually fed
+    filled = output.shape[1] - 1
+    presents = cache[..., :filled, :].transpose(2, 0, 1, 3, 4, 5)
+    return {
+        "tokens": output,
+        "presents": presents,
+        "lengths": lengths,
+        "proposed": proposed,
+        "accepted": accepted,
+    }
+
+
+def drain(steps):
+    """Runs one of the step generators to the end and returns its output."""
+    while True:
+        try:
+            next(steps)
+        except StopIteration as stop:
+            return stop.value
+
+
+def sample_sequence(**kwargs):
+    """Samples tokens with sample_steps and returns them with the presents and lengths."""
+    return drain(sample_steps(**kwargs))
+
+
+def speculative_sequence(**kwargs):
+    """Samples tokens with speculative_steps and returns them with the presents and lengths."""
+    return drain(speculative_steps(**kwargs))
@@ -0,0 +1,101 @@
+"""Smaller storage for the big weight matrices of numpy_model.
+
+With "int8" every output channel of a matrix gets its own scale (the
+largest absolute weight / 127) stored next to it as name + "/scale", with
+"float16" the matrices are just stored at half precision. Only the
+matrices of conv1d (c_attn, c_proj, c_fc) and wte are quantized, biases
+and layer norms are tiny and stay float32.
+
+NumPy has no fast matrix products of int8 or float16, so the weights are
+expanded back to float32 once when they are loaded (dequantize_params).
+The quantized files only take less disk space, the model runs with the
+memory and at the speed of float32.
+"""
+
+import numpy as np
+
+from generator.gpt2.src import numpy_model
+
+MODES = ("int8", "float16")
+
+
+def quantized(name):
+    return name.endswith(("/c_attn/w", "/c_proj/w", "/c_fc/w", "/wte"))
+
+
+def quantize_int8(w, axis):
+    """Symmetric int8 with one scale per slice along axis."""
+    reduce = tuple(i for i in range(w.ndim) if i != axis % w.ndim)
+    scale = np.max(np.abs(w), axis=reduce) / 127
+    scale = np.where(scale > 0, scale, 1).astype(np.float32)
+    shape = [1] * w.ndim
+    shape[axis] = -1
+    q = np.clip(np.round(w / scale.reshape(shape)), -127, 127).astype(np.int8)
+    return q, scale
+
+
+def quantize(name, value, mode):
+    """Returns the (name, array) pairs that replace the tensor name in a weight file."""
+    if mode is None or not quantized(name):
+        return [(name, value)]
+    if mode not in MODES:
+        raise ValueError("Unknown quantization %r, use one of %s" % (mode, MODES))
+    if mode == "float16":
+        return [(name, value.astype(np.float16))]
+    # Output channels are the last axis of conv1d weights and the rows of wte
+    q, scale = quantize_int8(value, 0 if name.endswith("/wte") else -1)
+    return [(name, q), (name + "/scale", scale)]
+
+
+def dequantize(name, value, scale=None):
+    """The float32 values of a tensor that quantize stored, scale is its name + "/scale"."""
+    value = value.astype(np.float32)
+    if scale is not None:
+        shape = [1] * value.ndim
+        shape[0 if name.endswith("/wte") else -1] = -1
+        value *= scale.reshape(shape)
+    return value
+
+
+def dequantize_params(params):
+    """Expands the quantized tensors of a name -> array mapping (a dict or WeightStore) to float32."""
+    result = {}
+    for name in params.keys():
+        if name.endswith("/scale"):
+            continue
+        scale = params[name + "/scale"] if name + "/scale" in params else None
+        result[name] = dequantize(name, np.asarray(params[name]), scale)
+    return result
+
+
+def quantize_params(params, mode):
+    """Quantizes a name -> array mapping (a dict or WeightStore) in memory."""
+    result = {}
+    for name in params.keys():
+        result.update(quantize(name, np.asarray(params[name]), mode))
+    return result
+
+
+def compare_logits(hparams, params, quantized_params, tokens):
+    """Runs tokens through both sets of weights and returns how far the logits are apart.
+
+    Gives the largest absolute difference of the logits and the fraction of
+    positions where both pick the same most likely token.
+    """
+    tokens = np.asarray(tokens, dtype=np.int32).reshape([1, -1])
+    logits = []
+    for p in (params, dequantize_params(quantized_params)):
+        cache = np.zeros(
+            numpy_model.cache_shape(
+                hparams=hparams, batch_size=1, capacity=tokens.shape[1]
+            ),
+            dtype=np.float32,
+        )
+        logits.append(
+            numpy_model.model(
+                hparams, p, tokens, cache=cache, cache_length=0, all_logits=True
+            )
+        )
+    error = float(np.max(np.abs(logits[0] - logits[1])))
+    agreement = float(np.mean(np.argmax(logits[0], -1) == np.argmax(logits[1], -1)))
+    return error, agreement
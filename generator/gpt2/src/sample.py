@@ -2,55 +2,193 @@ import tensorflow as tf
 from generator.gpt2.src import model
 
 
-def penalize_used(logits, output):
+def token_counts(output, mask, n_vocab, window=0):
+    """Counts the tokens of every row of output, padding is left out.
 
-    # I want to change the indices of logits wherever the index is found in output
-    change_tensor = tf.zeros_like(logits, dtype=logits.dtype)
-    unique = tf.unique(output[0])[0]
-    ones = tf.ones_like(unique, dtype=unique.dtype)
-    indices = tf.expand_dims(unique, 1)
+    With a window only the last window positions of a row are counted.
+    """
+    batch, length = model.shape_list(output)
+    window = tf.broadcast_to(tf.reshape(window, [-1]), [batch])[:, tf.newaxis]
+    positions = tf.range(length)[tf.newaxis, :]
+    recent = tf.logical_or(window <= 0, positions >= length - window)
+    weights = tf.cast(mask, tf.int32) * tf.cast(recent, tf.int32)
+    rows = tf.tile(tf.range(batch)[:, tf.newaxis], [1, length])
+    indices = tf.stack([rows, output], axis=-1)
+    return tf.scatter_nd(indices, weights, [batch, n_vocab])
 
-    updates = tf.scatter_nd(indices, ones, [logits.shape[1]])
 
-    bool_tensor = tf.expand_dims(tf.cast(updates, tf.bool), 0)
+def update_counts(counts, output, mask, window=0):
+    """Adds the last token of output to counts and removes the one that left the window.
 
-    return tf.compat.v1.where(bool_tensor, logits * 0.85, logits)
+    mask only has to cover output without its last token.
+    """
+    batch, length = model.shape_list(output)
+    window = tf.broadcast_to(tf.reshape(window, [-1]), [batch])
+    rows = tf.range(batch)
 
+    # mask ends before the last token, rows without a token leaving the
+    # window read any position inside it and ignore it
+    leaving = tf.stack(
+        [rows, tf.clip_by_value(length - window - 1, 0, length - 2)], axis=-1
+    )
+    left = tf.logical_and(window > 0, length - window - 1 >= 0)
+    left = tf.cast(left, tf.int32) * tf.cast(tf.gather_nd(mask, leaving), tf.int32)
 
-def top_k_logits(logits, k):
-    if k == 0:
-        # no truncation
-        return logits
+    indices = tf.concat(
+        [
+            tf.stack([rows, output[:, -1]], axis=-1),
+            tf.stack([rows, tf.gather_nd(output, leaving)], axis=-1),
+        ],
+        axis=0,
+    )
+    updates = tf.concat([tf.ones([batch], dtype=tf.int32), -left], axis=0)
+    return tf.tensor_scatter_nd_add(counts, indices, updates)
 
-    def _top_k():
-        values, _ = tf.nn.top_k(logits, k=k)
-        min_values = values[:, -1, tf.newaxis]
-        return tf.where(
-            logits < min_values,
-            tf.ones_like(logits, dtype=logits.dtype) * -1e10,
-            logits,
-        )
 
-    return tf.cond(tf.equal(k, 0), lambda: logits, lambda: _top_k(),)
+def penalize_used(
+    logits, counts, repetition_penalty=0.85, presence_penalty=0, frequency_penalty=0
+):
+    """Penalizes the tokens that have been used according to counts.
 
+    Their logits are scaled by repetition_penalty, presence_penalty is taken
+    off once and frequency_penalty once per use. All of them can be scalars
+    or one value per row.
+    """
+    used = counts > 0
+    repetition_penalty = tf.reshape(tf.cast(repetition_penalty, logits.dtype), [-1, 1])
+    presence_penalty = tf.reshape(tf.cast(presence_penalty, logits.dtype), [-1, 1])
+    frequency_penalty = tf.reshape(tf.cast(frequency_penalty, logits.dtype), [-1, 1])
 
-def top_p_logits(logits, p):
-    """Nucleus sampling"""
-    batch, _ = logits.shape.as_list()
-    sorted_logits = tf.sort(logits, direction="DESCENDING", axis=-1)
-    cumulative_probs = tf.cumsum(tf.nn.softmax(sorted_logits, axis=-1), axis=-1)
-    indices = tf.stack(
-        [
-            tf.range(0, batch),
-            # number of indices to include
-            tf.maximum(
-                tf.reduce_sum(tf.cast(cumulative_probs <= p, tf.int32), axis=-1) - 1, 0
-            ),
-        ],
+    logits = tf.compat.v1.where(used, logits * repetition_penalty, logits)
+    logits -= presence_penalty * tf.cast(used, logits.dtype)
+    logits -= frequency_penalty * tf.cast(counts, logits.dtype)
+    return logits
+
+
+def mix32(x):
+    """Integer hash of the low 32 bits of the int64 tensor x."""
+    low = tf.constant(0xFFFFFFFF, dtype=tf.int64)
+    x = tf.bitwise.bitwise_and(x, low)
+    x = tf.bitwise.bitwise_xor(x, tf.bitwise.right_shift(x, 16))
+    x = tf.bitwise.bitwise_and(x * 0x7FEB352D, low)
+    x = tf.bitwise.bitwise_xor(x, tf.bitwise.right_shift(x, 15))
+    x = tf.bitwise.bitwise_and(x * 0x2C1B3C6D, low)
+    return tf.bitwise.bitwise_xor(x, tf.bitwise.right_shift(x, 16))
+
+
+def uniform(seeds, counters):
+    """One draw in [0, 1) per row.
+
+    Rows with a seed >= 0 get a hash of their seed and counter, so the same
+    seed and counter always give the same draw, the others a random one.
+    """
+    seeds = tf.cast(seeds, tf.int64)
+    hashed = mix32(tf.bitwise.bitwise_xor(mix32(seeds), tf.cast(counters, tf.int64)))
+    hashed = tf.cast(hashed, tf.float64) / 2 ** 32
+    random = tf.random.uniform(tf.shape(seeds), dtype=tf.float64)
+    return tf.cast(tf.where(seeds >= 0, hashed, random), tf.float32)
+
+
+def sample_logits(logits, k, p, draws=None):
+    """Draws one token per row with top k and nucleus (top p) filtering.
+
+    Keeps the k most likely tokens, then the smallest of them whose
+    probabilities add up to p (up to ties with the k-th logit). Only the k
+    candidates returned by top_k are sorted, normalized and sampled from
+    instead of the whole vocabulary. k and p can be scalars or one value per row. draws are the
+    uniform numbers in [0, 1) that pick the tokens, random ones if None.
+    """
+    batch, vocab = model.shape_list(logits)
+    k = tf.broadcast_to(tf.reshape(k, [-1]), [batch])
+    k = tf.where(k > 0, k, tf.fill([batch], vocab))
+
+    # Candidates come back sorted, rows with a smaller k drop the rest
+    values, indices = tf.nn.top_k(logits, k=tf.reduce_max(k))
+    candidates = tf.range(tf.shape(values)[1])[tf.newaxis, :] < k[:, tf.newaxis]
+    values = tf.where(candidates, values, tf.ones_like(values) * -1e10)
+
+    cumulative_probs = tf.cumsum(tf.nn.softmax(values, axis=-1), axis=-1)
+    p = tf.reshape(tf.cast(p, cumulative_probs.dtype), [-1, 1])
+    last = tf.maximum(
+        tf.reduce_sum(tf.cast(cumulative_probs <= p, tf.int32), axis=-1) - 1, 0
+    )
+    min_values = tf.gather_nd(values, tf.stack([tf.range(batch), last], axis=-1))
+    values = tf.where(
+        values < min_values[:, tf.newaxis], tf.ones_like(values) * -1e10, values,
+    )
+
+    # Inverse transform sampling, the first candidate past the draw
+    if draws is None:
+        draws = tf.random.uniform([batch])
+    cumulative_probs = tf.cumsum(tf.nn.softmax(values, axis=-1), axis=-1)
+    draws = draws[:, tf.newaxis] * cumulative_probs[:, -1:]
+    choices = tf.minimum(
+        tf.reduce_sum(tf.cast(cumulative_probs <= draws, tf.int32), axis=-1),
+        tf.shape(values)[1] - 1,
+    )
+    samples = tf.gather_nd(indices, tf.stack([tf.range(batch), choices], axis=-1))
+    return samples[:, tf.newaxis]
+
+
+def stopped(output, stop_sequences):
+    """Returns which rows of output end with one of their stop sequences.
+
+    stop_sequences has shape [batch, sequences, length], every sequence is
+    right aligned and padded with -1.
+    """
+    width = tf.shape(stop_sequences)[-1]
+    tail = output[:, -width:]
+    tail = tf.pad(tail, [[0, 0], [width - tf.shape(tail)[1], 0]], constant_values=-2)
+    match = tf.reduce_all(
+        tf.logical_or(
+            tf.equal(stop_sequences, tail[:, tf.newaxis, :]), stop_sequences < 0
+        ),
         axis=-1,
     )
-    min_values = tf.gather_nd(sorted_logits, indices)
-    return tf.where(logits < min_values, tf.ones_like(logits) * -1e10, logits,)
+    match = tf.logical_and(match, stop_sequences[:, :, -1] >= 0)
+    return tf.reduce_any(match, axis=-1)
+
+
+def ban_sequences(logits, output, banned_sequences, word_breaks):
+    """Masks the last token of every banned sequence that output ends with the rest of, where it starts a word.
+
+    banned_sequences is laid out like the stop_sequences of stopped.
+    word_breaks has a bit per token: 1 if its text starts with a character
+    that is not part of a word, 2 if it ends with one. A sequence starts a
+    word if its first token starts with a break or follows a token that
+    ends with one (or the start of output). So a sequence of a single token
+    is masked at every word start, and pieces inside other words
+    ("seashell") are never touched.
+    """
+    batch, vocab = model.shape_list(logits)
+    prefix = banned_sequences[:, :, :-1]
+    width = tf.shape(banned_sequences)[-1]
+    # The prefixes and the token before the longest one, -2 before the start of output
+    tail = output[:, tf.maximum(tf.shape(output)[1] - width, 0) :]
+    tail = tf.pad(tail, [[0, 0], [width - tf.shape(tail)[1], 0]], constant_values=-2)
+    match = tf.reduce_all(
+        tf.logical_or(tf.equal(prefix, tail[:, tf.newaxis, 1:]), prefix < 0), axis=-1,
+    )
+
+    lengths = tf.reduce_sum(tf.cast(banned_sequences >= 0, tf.int32), axis=-1)
+    start = tf.minimum(width - lengths, width - 1)
+    first = tf.gather(banned_sequences, start, axis=2, batch_dims=2)
+    before = tf.gather(tail, start, axis=1, batch_dims=1)
+    starts_word = tf.logical_or(
+        tf.bitwise.bitwise_and(tf.gather(word_breaks, tf.maximum(first, 0)), 1) > 0,
+        tf.logical_or(
+            tf.equal(before, -2),
+            tf.bitwise.bitwise_and(tf.gather(word_breaks, tf.maximum(before, 0)), 2) > 0,
+        ),
+    )
+    match = tf.logical_and(tf.logical_and(match, lengths > 0), starts_word)
+
+    tokens = tf.maximum(banned_sequences[:, :, -1], 0)
+    rows = tf.broadcast_to(tf.range(batch)[:, tf.newaxis], tf.shape(tokens))
+    banned = tf.scatter_nd(
+        tf.stack([rows, tokens], axis=-1), tf.cast(match, tf.int32), [batch, vocab]
+    )
+    return tf.where(banned > 0, tf.ones_like(logits) * -1e10, logits)
 
 
 def sample_sequence(
@@ -60,22 +198,68 @@ def sample_sequence(
     start_token=None,
     batch_size=None,
     context=None,
+    past=None,
+    mask=None,
+    stop_sequences=None,
+    banned_sequences=None,
+    word_breaks=None,
+    fixed_cache=False,
+    prefill_chunk=None,
     temperature=1,
     top_k=0,
-    top_p=1
+    top_p=1,
+    repetition_penalty=0.85,
+    presence_penalty=0,
+    frequency_penalty=0,
+    penalty_window=0,
+    seed=-1
 ):
+    """Samples length tokens after context in two phases.
+
+    Prefill runs the context (after the part covered by past) through the
+    model, prefill_chunk tokens at a time if set so long prompts do not need
+    the attention weights of all of them at once. Decode then feeds one
+    token per step, which needs no causal mask and keeps its positions in
+    the loop. No word of banned_sequences is ever finished, see
+    ban_sequences for word_breaks.
+    """
     if start_token is None:
         assert context is not None, "Specify exactly one of start_token and context!"
     else:
         assert context is None, "Specify exactly one of start_token and context!"
         context = tf.fill([batch_size, 1], start_token)
 
-    def step(hparams, tokens, past=None):
+    # length, temperature, top_k and top_p can also be tensors with one value
+    # per row, so one graph serves any sampling settings
+    row_length = tf.reshape(tf.cast(length, tf.int32), [-1])
+    length = tf.reduce_max(row_length)
+
+    def step(
+        hparams,
+        tokens,
+        past=None,
+        mask=None,
+        cache=None,
+        cache_length=None,
+        positions=None,
+    ):
         lm_output = model.model(
-            hparams=hparams, X=tokens, past=past, reuse=tf.AUTO_REUSE
+            hparams=hparams,
+            X=tokens,
+            past=past,
+            reuse=tf.AUTO_REUSE,
+            mask=mask,
+            cache=cache,
+            cache_length=cache_length,
+            positions=positions,
         )
 
         logits = lm_output["logits"][:, :, : hparams.n_vocab]
+        if cache is not None:
+            return {
+                "logits": logits,
+                "cache": lm_output["cache"],
+            }
         presents = lm_output["present"]
         presents.set_shape(model.past_shape(hparams=hparams, batch_size=batch_size))
         return {
@@ -85,39 +269,219 @@ def sample_sequence(
 
     with tf.name_scope("sample_sequence"):
 
-        def body(past, prev, output):
-            next_outputs = step(hparams, prev, past=past)
-            logits = next_outputs["logits"][:, -1, :] / tf.to_float(temperature)
-            logits = penalize_used(logits, output)
-            logits = top_k_logits(logits, k=top_k)
-            logits = top_p_logits(logits, p=top_p)
-            samples = tf.multinomial(logits, num_samples=1, output_dtype=tf.int32)
+        def next_token(logits, output, mask, done, lengths, counts):
+            logits = logits[:, -1, :] / tf.reshape(tf.to_float(temperature), [-1, 1])
+            logits = penalize_used(
+                logits,
+                counts,
+                repetition_penalty=repetition_penalty,
+                presence_penalty=presence_penalty,
+                frequency_penalty=frequency_penalty,
+            )
+            if banned_sequences is not None:
+                logits = ban_sequences(logits, output, banned_sequences, word_breaks)
+            # mask covers output, padding is not counted
+            draws = uniform(
+                tf.broadcast_to(tf.reshape(seed, [-1]), [tf.shape(output)[0]]),
+                tf.reduce_sum(tf.cast(mask, tf.int32), axis=1),
+            )
+            samples = sample_logits(logits, k=top_k, p=top_p, draws=draws)
+            output = tf.concat([output, samples], axis=1)
+            counts = update_counts(counts, output, mask, window=penalty_window)
+            lengths = lengths + tf.cast(tf.logical_not(done), tf.int32)
+            done = tf.logical_or(done, stopped(output, stop_sequences))
+            done = tf.logical_or(done, lengths >= row_length)
+            return samples, output, done, lengths, counts
+
+        def prefill(past, context, mask):
+            """Returns past extended by the tokens of context it does not cover yet and their last logits."""
+            past_length = tf.shape(past)[-2]
+            tokens = context[:, past_length:]
+            if prefill_chunk is None:
+                next_outputs = step(hparams, tokens, past=past, mask=mask)
+                return (
+                    tf.concat([past, next_outputs["presents"]], axis=-2),
+                    next_outputs["logits"][:, -1:],
+                )
+
+            def chunk_body(past, start, logits):
+                end = tf.minimum(start + prefill_chunk, tf.shape(tokens)[1])
+                next_outputs = step(
+                    hparams,
+                    tokens[:, start:end],
+                    past=past,
+                    mask=mask[:, : past_length + end],
+                )
+                return [
+                    tf.concat([past, next_outputs["presents"]], axis=-2),
+                    end,
+                    next_outputs["logits"][:, -1:],
+                ]
+
+            past, _, logits = tf.while_loop(
+                cond=lambda past, start, logits: start < tf.shape(tokens)[1],
+                body=chunk_body,
+                loop_vars=[
+                    past,
+                    tf.constant(0),
+                    tf.zeros([tf.shape(context)[0], 1, hparams.n_vocab]),
+                ],
+                shape_invariants=[
+                    tf.TensorShape(
+                        model.past_shape(hparams=hparams, batch_size=batch_size)
+                    ),
+                    tf.TensorShape([]),
+                    tf.TensorShape([batch_size, None, hparams.n_vocab]),
+                ],
+                back_prop=False,
+            )
+            return past, logits
+
+        def body(past, prev, output, mask, positions, done, lengths, counts):
+            # mask covers past and prev
+            next_outputs = step(
+                hparams, prev, past=past, mask=mask, positions=positions[:, tf.newaxis]
+            )
+            samples, output, done, lengths, counts = next_token(
+                next_outputs["logits"], output, mask, done, lengths, counts
+            )
             return [
-                next_outputs["presents"]
-                if past is None
-                else tf.concat([past, next_outputs["presents"]], axis=-2),
+                tf.concat([past, next_outputs["presents"]], axis=-2),
                 samples,
-                tf.concat([output, samples], axis=1),
+                output,
+                tf.concat([mask, tf.ones_like(samples, dtype=mask.dtype)], axis=1),
+                positions + 1,
+                done,
+                lengths,
+                counts,
             ]
 
-        past, prev, output = body(None, context, context)
+        def cache_body(cache, prev, output, mask, positions, done, lengths, counts):
+            # Everything before prev is in the cache, mask spans its whole capacity
+            filled = tf.shape(output)[1] - 1
+            next_outputs = step(
+                hparams,
+                prev,
+                mask=mask,
+                cache=cache,
+                cache_length=filled,
+                positions=positions[:, tf.newaxis],
+            )
+            samples, output, done, lengths, counts = next_token(
+                next_outputs["logits"],
+                output,
+                mask[:, : filled + 1],
+                done,
+                lengths,
+                counts,
+            )
+            return [
+                next_outputs["cache"],
+                samples,
+                output,
+                mask,
+                positions + 1,
+                done,
+                lengths,
+                counts,
+            ]
 
-        def cond(*args):
-            return True
-
-        _, _, tokens = tf.while_loop(
-            cond=cond,
-            body=body,
-            maximum_iterations=length - 1,
-            loop_vars=[past, prev, output],
-            shape_invariants=[
-                tf.TensorShape(
-                    model.past_shape(hparams=hparams, batch_size=batch_size)
-                ),
-                tf.TensorShape([batch_size, None]),
-                tf.TensorShape([batch_size, None]),
-            ],
-            back_prop=False,
+        # mask marks the left padding of batched contexts with 0
+        if mask is None:
+            mask = tf.ones_like(context, dtype=tf.float32)
+        if stop_sequences is None:
+            stop_sequences = tf.fill([tf.shape(context)[0], 1, 1], -1)
+        if past is None:
+            past = tf.zeros(
+                model.past_shape(
+                    hparams=hparams, batch_size=tf.shape(context)[0], sequence=0
+                )
+            )
+        done = tf.zeros([tf.shape(context)[0]], dtype=tf.bool)
+        lengths = tf.zeros([tf.shape(context)[0]], dtype=tf.int32)
+        context_mask = mask
+        # Running token counts for the penalty, updated once per step
+        counts = token_counts(context, mask, hparams.n_vocab, window=penalty_window)
+
+        # Tokens already covered by past only need to be kept for the penalty
+        past, logits = prefill(past, context, mask)
+        prev, output, done, lengths, counts = next_token(
+            logits, context, mask, done, lengths, counts
         )
+        mask = tf.concat([mask, tf.ones_like(prev, dtype=mask.dtype)], axis=1)
+        # The position of prev is the number of real tokens before it
+        positions = tf.reduce_sum(tf.cast(context_mask, tf.int32), axis=1)
+
+        def cond(*args):
+            # Stop as soon as every row produced one of its stop sequences
+            done = args[5]
+            return tf.logical_not(tf.reduce_all(done))
 
-        return tokens
+        if not fixed_cache:
+            presents, _, tokens, _, _, _, lengths, _ = tf.while_loop(
+                cond=cond,
+                body=body,
+                maximum_iterations=length - 1,
+                loop_vars=[past, prev, output, mask, positions, done, lengths, counts],
+                shape_invariants=[
+                    tf.TensorShape(
+                        model.past_shape(hparams=hparams, batch_size=batch_size)
+                    ),
+                    tf.TensorShape([batch_size, 1]),
+                    tf.TensorShape([batch_size, None]),
+                    tf.TensorShape([batch_size, None]),
+                    tf.TensorShape([batch_size]),
+                    tf.TensorShape([batch_size]),
+                    tf.TensorShape([batch_size]),
+                    tf.TensorShape([batch_size, hparams.n_vocab]),
+                ],
+                back_prop=False,
+            )
+        else:
+            # Allocate room for every token that will be fed once, the loop
+            # then writes each step's keys and values into it in place
+            cache = tf.pad(
+                tf.transpose(past, [1, 2, 0, 3, 4, 5]),
+                [[0, 0], [0, 0], [0, 0], [0, 0], [0, length - 1], [0, 0]],
+            )
+            cache = tf.unstack(cache, num=hparams.n_layer, axis=0)
+            mask = tf.concat(
+                [
+                    context_mask,
+                    tf.ones([tf.shape(context)[0], length - 1], dtype=mask.dtype),
+                ],
+                axis=1,
+            )
+
+            cache, _, tokens, _, _, _, lengths, _ = tf.while_loop(
+                cond=cond,
+                body=cache_body,
+                maximum_iterations=length - 1,
+                loop_vars=[cache, prev, output, mask, positions, done, lengths, counts],
+                shape_invariants=[
+                    [
+                        tf.TensorShape(
+                            model.cache_shape(hparams=hparams, batch_size=batch_size)
+                        )
+                    ]
+                    * hparams.n_layer,
+                    tf.TensorShape([batch_size, 1]),
+                    tf.TensorShape([batch_size, None]),
+                    tf.TensorShape([batch_size, None]),
+                    tf.TensorShape([batch_size]),
+                    tf.TensorShape([batch_size]),
+                    tf.TensorShape([batch_size]),
+                    tf.TensorShape([batch_size, hparams.n_vocab]),
+                ],
+                back_prop=False,
+            )
+
+            # Back to the layout of past, cut to the tokens actually fed
+            presents = tf.transpose(tf.stack(cache, axis=0), [2, 0, 1, 3, 4, 5])
+            presents = presents[:, :, :, :, : tf.shape(tokens)[1] - 1]
+
+        return {
+            "tokens": tokens,
+            "presents": presents,
+            "lengths": lengths,
+        }
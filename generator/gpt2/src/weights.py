@@ -0,0 +1,115 @@
+"""Flat weight files that are memory-mapped instead of restored.
+
+convert writes every tensor of a checkpoint into one file (weights.bin),
+each one starting at an ALIGNMENT byte boundary, and a manifest
+(weights.json) with their names, dtypes, shapes and offsets. WeightStore
+maps the file once and hands out views into it, so nothing is read until a
+tensor is used and processes on one host share the same page cache.
+
+A quantized conversion (see quantize.py) is kept next to it as
+weights-int8.bin or weights-float16.bin.
+"""
+
+import json
+import os
+
+import numpy as np
+
+from generator.gpt2.src import checkpoint, quantize as quantization
+
+ALIGNMENT = 64
+VERSION = 1
+
+
+def store_paths(checkpoint_dir, quantize=None):
+    """Returns the paths of the weight file and its manifest."""
+    name = "weights" if quantize is None else "weights-" + quantize
+    return (
+        os.path.join(checkpoint_dir, name + ".bin"),
+        os.path.join(checkpoint_dir, name + ".json"),
+    )
+
+
+def convert(checkpoint_dir, prefix=None, quantize=None):
+    """Writes the weight file and manifest of the checkpoint into checkpoint_dir."""
+    if prefix is None:
+        prefix = checkpoint.latest_checkpoint(checkpoint_dir)
+    reader = checkpoint.CheckpointReader(prefix)
+
+    tensors = {}
+    path, manifest_path = store_paths(checkpoint_dir, quantize)
+    with open(path + ".tmp", "wb") as f:
+        for name in reader.names():
+            value = np.asarray(reader.get_tensor(name))
+            for stored_name, stored in quantization.quantize(name, value, quantize):
+                f.write(b"\0" * (-f.tell() % ALIGNMENT))
+                offset = f.tell()
+                f.write(stored.tobytes())
+                tensors[stored_name] = {
+                    "dtype": stored.dtype.str,
+                    "shape": list(stored.shape),
+                    "offset": offset,
+                }
+    manifest = {
+        "version": VERSION,
+        "checkpoint": os.path.basename(prefix),
+        "quantize": quantize,
+        "tensors": tensors,
+    }
+    with open(manifest_path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=1)
+
+    # Only a finished conversion replaces the old files
+    os.replace(path + ".tmp", path)
+    os.replace(manifest_path + ".tmp", manifest_path)
+    return manifest
+
+
+class WeightStore:
+    """Read-only mapping from tensor names to arrays backed by the weight file."""
+
+    def __init__(self, checkpoint_dir, quantize=None):
+        path, manifest_path = store_paths(checkpoint_dir, quantize)
+        with open(manifest_path) as f:
+            self.manifest = json.load(f)
+        if self.manifest.get("version") != VERSION:
+            raise ValueError(
+                "%s has version %s, convert the checkpoint again"
+                % (manifest_path, self.manifest.get("version"))
+            )
+        self.data = np.memmap(path, dtype=np.uint8, mode="r")
+        self.tensors = {}
+
+    def __contains__(self, name):
+        return name in self.manifest["tensors"]
+
+    def __getitem__(self, name):
+        if name not in self.tensors:
+            entry = self.manifest["tensors"][name]
+            dtype = np.dtype(entry["dtype"])
+            size = int(np.prod(entry["shape"])) * dtype.itemsize
+            start = entry["offset"]
+            self.tensors[name] = (
+                self.data[start : start + size].view(dtype).reshape(entry["shape"])
+            )
+        return self.tensors[name]
+
+    def keys(self):
+        return self.manifest["tensors"].keys()
+
+    def names(self):
+        return sorted(self.manifest["tensors"])
+
+
+def open_store(checkpoint_dir, quantize=None):
+    """Returns the WeightStore of checkpoint_dir, None if it has none for the latest checkpoint."""
+    if not os.path.exists(store_paths(checkpoint_dir, quantize)[1]):
+        return None
+    store = WeightStore(checkpoint_dir, quantize)
+    # The checkpoint itself can be deleted once it is converted
+    if os.path.exists(os.path.join(checkpoint_dir, "checkpoint")):
+        prefix = checkpoint.latest_checkpoint(checkpoint_dir)
+        if prefix is not None and os.path.basename(prefix) != store.manifest["checkpoint"]:
+            # Converted from an older checkpoint
+            return None
+    return store
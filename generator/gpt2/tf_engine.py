@@ -0,0 +1,441 @@
+import json
+import os
+import time
+
+import numpy as np
+
+# XLA only clusters CPU ops with this flag, which TF reads once before the
+# first session. It does nothing unless a session turns on global_jit_level.
+if "--tf_xla_cpu_global_jit" not in os.environ.get("TF_XLA_FLAGS", ""):
+    os.environ["TF_XLA_FLAGS"] = (
+        os.environ.get("TF_XLA_FLAGS", "") + " --tf_xla_cpu_global_jit"
+    ).strip()
+
+import tensorflow as tf
+from generator.gpt2.src import model, numpy_sample, sample, weights
+from tensorflow.core.protobuf import rewriter_config_pb2
+from tensorflow.python.grappler import tf_optimizer
+
+tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
+
+INPUTS = [
+    "context",
+    "mask",
+    "past",
+    "stop_sequences",
+    "banned_sequences",
+    "word_breaks",
+    "length",
+    "temperature",
+    "top_k",
+    "top_p",
+    "repetition_penalty",
+    "presence_penalty",
+    "frequency_penalty",
+    "penalty_window",
+    "seed",
+]
+OUTPUTS = ["tokens", "presents", "lengths"]
+
+# Tokens sampled per session run by generate_stream
+STREAM_TOKENS = 8
+
+EXPORT_GRAPH = "graph.pb"
+EXPORT_MANIFEST = "export.json"
+EXPORT_VERSION = 4
+# A GraphDef has to stay below the 2GB limit of protocol buffers
+MAX_FROZEN_SIZE = 2 ** 31 - 2 ** 26
+
+
+def optimize_graph(graph_def, fetches):
+    """Runs the Grappler optimizers over graph_def, keeping the nodes named in fetches."""
+    graph = tf.Graph()
+    with graph.as_default():
+        tf.import_graph_def(graph_def, name="")
+        meta_graph = tf.compat.v1.train.export_meta_graph(graph=graph)
+    # Grappler keeps whatever is in the train_op collection
+    meta_graph.collection_def["train_op"].node_list.value.extend(fetches)
+
+    config = tf.compat.v1.ConfigProto()
+    rewrite_options = config.graph_options.rewrite_options
+    rewrite_options.optimizers.extend(
+        ["constfold", "shape", "arithmetic", "dependency", "loop", "remap"]
+    )
+    rewrite_options.meta_optimizer_iterations = rewriter_config_pb2.RewriterConfig.TWO
+    return tf_optimizer.OptimizeGraph(config, meta_graph)
+
+
+def compiled_clusters(run_metadata):
+    """Returns whether a run with output_partition_graphs ran any XLA clusters."""
+    return any(
+        node.op in ("_XlaRun", "XlaLaunch")
+        for graph in run_metadata.partition_graphs
+        for node in graph.node
+    )
+
+
+class TFEngine:
+    """Runs sample_sequence as one TensorFlow graph.
+
+    The batch size and every sampling setting are fed at run time, so the
+    graph is built and the checkpoint restored only once. With xla the
+    session JIT compiles the graph with XLA, which fuses the chains of small
+    ops (layer norms, gelu, head reshapes, attention masks) of every step. If
+    that fails or no op ends up in a compiled cluster the engine falls back
+    to the plain session.
+
+    export writes the graph for the current settings as an optimized
+    GraphDef, with export_dir an engine loads it instead of building one.
+    fixed_cache and prefill_chunk are then the ones it was exported with,
+    giving others raises a ValueError.
+    """
+
+    def __init__(
+        self,
+        checkpoint_dir,
+        force_cpu=False,
+        fixed_cache=None,
+        xla=False,
+        prefill_chunk=None,
+        export_dir=None,
+        intra_op_threads=0,
+        inter_op_threads=0,
+    ):
+        hparams = model.default_hparams()
+        with open(os.path.join(checkpoint_dir, "hparams.json")) as f:
+            hparams.override_from_dict(json.load(f))
+        self.hparams = hparams
+        self.checkpoint_dir = checkpoint_dir
+        self.force_cpu = force_cpu
+        # 0 lets TensorFlow pick, see cpu_profile.py
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+
+        # Every engine has its own graph so several can live in one process
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            if export_dir is None:
+                self.build(bool(fixed_cache), prefill_chunk)
+            else:
+                self.load_export(export_dir, fixed_cache, prefill_chunk)
+
+        self.xla = xla
+        self.sess = self.start_session(xla)
+        if xla:
+            try:
+                # The first run compiles, so failures show up here and not mid game
+                start = time.time()
+                run_metadata = tf.compat.v1.RunMetadata()
+                self.warm_up(run_metadata)
+                if not compiled_clusters(run_metadata):
+                    raise ValueError("no ops were clustered")
+                print("XLA compiled the graph in %.1fs" % (time.time() - start))
+            except (tf.errors.OpError, ValueError) as e:
+                print("XLA compilation failed, running without it:", e)
+                self.sess.close()
+                self.xla = False
+                self.sess = self.start_session(False)
+
+    def build(self, fixed_cache, prefill_chunk):
+        hparams = self.hparams
+        self.config = {"fixed_cache": fixed_cache, "prefill_chunk": prefill_chunk}
+
+        # Inputs and outputs are named so an exported graph can be fed the same way
+        self.context = tf.placeholder(tf.int32, [None, None], name="context")
+        self.mask = tf.placeholder(tf.float32, [None, None], name="mask")
+        self.past = tf.placeholder(
+            tf.float32, model.past_shape(hparams=hparams), name="past"
+        )
+        self.stop_sequences = tf.placeholder(
+            tf.int32, [None, None, None], name="stop_sequences"
+        )
+        self.banned_sequences = tf.placeholder(
+            tf.int32, [None, None, None], name="banned_sequences"
+        )
+        self.word_breaks = tf.placeholder(tf.int32, [None], name="word_breaks")
+
+        self.length = tf.placeholder(tf.int32, [None], name="length")
+        self.temperature = tf.placeholder(tf.float32, [None], name="temperature")
+        self.top_k = tf.placeholder(tf.int32, [None], name="top_k")
+        self.top_p = tf.placeholder(tf.float32, [None], name="top_p")
+        self.repetition_penalty = tf.placeholder(
+            tf.float32, [None], name="repetition_penalty"
+        )
+        self.presence_penalty = tf.placeholder(
+            tf.float32, [None], name="presence_penalty"
+        )
+        self.frequency_penalty = tf.placeholder(
+            tf.float32, [None], name="frequency_penalty"
+        )
+        self.penalty_window = tf.placeholder(tf.int32, [None], name="penalty_window")
+        self.seed = tf.placeholder(tf.int32, [None], name="seed")
+
+        output = sample.sample_sequence(
+            hparams=hparams,
+            length=self.length,
+            context=self.context,
+            past=self.past,
+            mask=self.mask,
+            stop_sequences=self.stop_sequences,
+            banned_sequences=self.banned_sequences,
+            word_breaks=self.word_breaks,
+            fixed_cache=fixed_cache,
+            prefill_chunk=prefill_chunk,
+            temperature=self.temperature,
+            top_k=self.top_k,
+            top_p=self.top_p,
+            repetition_penalty=self.repetition_penalty,
+            presence_penalty=self.presence_penalty,
+            frequency_penalty=self.frequency_penalty,
+            penalty_window=self.penalty_window,
+            seed=self.seed,
+        )
+        self.output = {name: tf.identity(output[name], name=name) for name in OUTPUTS}
+        self.saver = tf.train.Saver()
+        self.frozen = False
+        self.restore_op = self.saver.saver_def.restore_op_name
+        self.filename_tensor = self.saver.saver_def.filename_tensor_name
+
+    def load_export(self, export_dir, fixed_cache=None, prefill_chunk=None):
+        with open(os.path.join(export_dir, EXPORT_MANIFEST)) as f:
+            manifest = json.load(f)
+        if manifest["version"] != EXPORT_VERSION:
+            raise ValueError(
+                "%s was exported with version %s, export it again"
+                % (export_dir, manifest["version"])
+            )
+        self.config = manifest["config"]
+        for key, value in (("fixed_cache", fixed_cache), ("prefill_chunk", prefill_chunk)):
+            if value is not None and value != self.config[key]:
+                raise ValueError(
+                    "%s was exported with %s=%r, not %r"
+                    % (export_dir, key, self.config[key], value)
+                )
+        # Variables are restored from the latest checkpoint, frozen weights are the exported ones
+        latest = tf.train.latest_checkpoint(self.checkpoint_dir)
+        if (
+            manifest["frozen"]
+            and latest is not None
+            and os.path.basename(latest) != manifest["checkpoint"]
+        ):
+            raise ValueError(
+                "%s froze the weights of %s, not of the latest checkpoint %s, export it again"
+                % (export_dir, manifest["checkpoint"], os.path.basename(latest))
+            )
+        self.saver = None
+        self.frozen = manifest["frozen"]
+        self.restore_op = manifest["restore_op"]
+        self.filename_tensor = manifest["filename_tensor"]
+
+        graph_def = tf.compat.v1.GraphDef()
+        with open(os.path.join(export_dir, EXPORT_GRAPH), "rb") as f:
+            graph_def.ParseFromString(f.read())
+        tf.import_graph_def(graph_def, name="")
+        for name in INPUTS:
+            setattr(self, name, self.graph.get_tensor_by_name(name + ":0"))
+        self.output = {
+            name: self.graph.get_tensor_by_name(name + ":0") for name in OUTPUTS
+        }
+
+    def export(self, export_dir):
+        """Writes the graph of this engine to export_dir, optimized by Grappler.
+
+        If the weights fit into one GraphDef (protocol buffers are limited to
+        2GB) they are frozen into it as constants, so loading it needs no
+        checkpoint and constant folding can work through them. Otherwise the
+        variables stay and are restored from the checkpoint.
+        """
+        fetches = list(OUTPUTS)
+        with self.graph.as_default():
+            variables = tf.compat.v1.global_variables()
+            graph_def = self.graph.as_graph_def()
+        size = sum(v.shape.num_elements() * v.dtype.base_dtype.size for v in variables)
+        frozen = size < MAX_FROZEN_SIZE
+        if frozen:
+            graph_def = tf.compat.v1.graph_util.convert_variables_to_constants(
+                self.sess, graph_def, fetches
+            )
+        else:
+            # Keep the saver's ops for restoring the variables
+            fetches += [
+                self.restore_op.split(":")[0],
+                self.filename_tensor.split(":")[0],
+            ]
+        graph_def = optimize_graph(graph_def, fetches)
+
+        os.makedirs(export_dir, exist_ok=True)
+        with open(os.path.join(export_dir, EXPORT_GRAPH), "wb") as f:
+            f.write(graph_def.SerializeToString())
+        manifest = {
+            "version": EXPORT_VERSION,
+            "tensorflow": tf.__version__,
+            "checkpoint": os.path.basename(
+                tf.train.latest_checkpoint(self.checkpoint_dir) or ""
+            ),
+            "config": self.config,
+            "frozen": frozen,
+            "restore_op": self.restore_op,
+            "filename_tensor": self.filename_tensor,
+        }
+        with open(os.path.join(export_dir, EXPORT_MANIFEST), "w") as f:
+            json.dump(manifest, f, indent=1)
+        return manifest
+
+    def start_session(self, xla):
+        config = None
+        if self.force_cpu:
+            config = tf.compat.v1.ConfigProto(
+                device_count={"GPU": 0}
+            )
+        else:
+            config = tf.compat.v1.ConfigProto()
+            config.gpu_options.allow_growth = True
+        config.intra_op_parallelism_threads = self.intra_op_threads
+        config.inter_op_parallelism_threads = self.inter_op_threads
+        if xla:
+            config.graph_options.optimizer_options.global_jit_level = (
+                tf.compat.v1.OptimizerOptions.ON_1
+            )
+        sess = tf.compat.v1.Session(graph=self.graph, config=config)
+
+        if self.frozen:
+            return sess
+        store = None if self.saver is None else weights.open_store(self.checkpoint_dir)
+        if store is None:
+            ckpt = tf.train.latest_checkpoint(self.checkpoint_dir)
+            sess.run(self.restore_op, {self.filename_tensor: ckpt})
+        else:
+            # The mapped weights are fed straight into the variables
+            with self.graph.as_default():
+                for variable in tf.compat.v1.global_variables():
+                    variable.load(store[variable.op.name], sess)
+        return sess
+
+    def warm_up(self, run_metadata=None):
+        """Generates two tokens from a one token context."""
+        self.generate(
+            [[0]],
+            [[1]],
+            np.zeros(self.past_shape(batch_size=1, sequence=0), dtype=np.float32),
+            np.full([1, 1, 1], -1, dtype=np.int32),
+            [
+                {
+                    "generate_num": 2,
+                    "temperature": 1.0,
+                    "top_k": 0,
+                    "top_p": 1.0,
+                    "repetition_penalty": 1.0,
+                    "presence_penalty": 0.0,
+                    "frequency_penalty": 0.0,
+                    "penalty_window": 0,
+                }
+            ],
+            run_metadata=run_metadata,
+        )
+
+    def past_shape(self, batch_size=None, sequence=None):
+        return model.past_shape(
+            hparams=self.hparams, batch_size=batch_size, sequence=sequence
+        )
+
+    def generate(
+        self,
+        context,
+        mask,
+        past,
+        stop_sequences,
+        options,
+        banned_sequences=None,
+        word_breaks=None,
+        run_metadata=None,
+    ):
+        """Returns the tokens, presents and lengths of sample_sequence, options has one dict per row.
+
+        run_metadata is filled with the partition graphs of the run.
+        """
+        if banned_sequences is None:
+            banned_sequences = np.full([len(options), 1, 1], -1, dtype=np.int32)
+            # Only read for banned sequences
+            word_breaks = np.zeros([self.hparams.n_vocab], dtype=np.int32)
+        tokens, presents, lengths = self.sess.run(
+            [self.output["tokens"], self.output["presents"], self.output["lengths"]],
+            feed_dict={
+                self.context: context,
+                self.mask: mask,
+                self.past: past,
+                self.stop_sequences: stop_sequences,
+                self.banned_sequences: banned_sequences,
+                self.word_breaks: word_breaks,
+                self.length: [o["generate_num"] for o in options],
+                self.temperature: [o["temperature"] for o in options],
+                self.top_k: [o["top_k"] for o in options],
+                self.top_p: [o["top_p"] for o in options],
+                self.repetition_penalty: [o["repetition_penalty"] for o in options],
+                self.presence_penalty: [o["presence_penalty"] for o in options],
+                self.frequency_penalty: [o["frequency_penalty"] for o in options],
+                self.penalty_window: [o["penalty_window"] for o in options],
+                # None draws random tokens
+                self.seed: [
+                    -1 if o.get("seed") is None else o["seed"] for o in options
+                ],
+            },
+            options=None
+            if run_metadata is None
+            else tf.compat.v1.RunOptions(output_partition_graphs=True),
+            run_metadata=run_metadata,
+        )
+        return {
+            "tokens": tokens,
+            "presents": presents,
+            "lengths": lengths,
+        }
+
+    def generate_stream(
+        self,
+        context,
+        mask,
+        past,
+        stop_sequences,
+        options,
+        banned_sequences=None,
+        word_breaks=None,
+    ):
+        """Same as generate for a single row, but yields the [1, n] new tokens as they are sampled.
+
+        The graph samples a whole sequence per run, so it is run for
+        STREAM_TOKENS tokens at a time, continuing from the presents of the
+        last run. Every step still sees the same tokens and penalties. The
+        output of generate is the return value of the generator.
+        """
+        context = np.asarray(context, dtype=np.int32)
+        mask = np.asarray(mask, dtype=np.float32)
+        prompt_length = context.shape[1]
+        total = options[0]["generate_num"]
+        presents = past
+        generated = 0
+        while generated < total:
+            step = min(STREAM_TOKENS, total - generated)
+            output = self.generate(
+                context,
+                mask,
+                presents,
+                stop_sequences,
+                [dict(options[0], generate_num=step)],
+                banned_sequences,
+                word_breaks,
+            )
+            length = output["lengths"][0]
+            end = context.shape[1] + length
+            yield output["tokens"][:, context.shape[1] : end]
+            generated += length
+            context = output["tokens"][:, :end]
+            mask = np.concatenate([mask, np.ones([1, length], dtype=np.float32)], axis=1)
+            # The last token is fed by the next run
+            presents = output["presents"][..., : end - 1, :]
+            if length < step or numpy_sample.stopped(context, stop_sequences)[0]:
+                break
+        return {
+            "tokens": context,
+            "presents": presents,
+            "lengths": np.array([context.shape[1] - prompt_length], dtype=np.int32),
+        }
@@ -0,0 +1,157 @@
+"""Finds the fastest thread and replica settings of the TensorFlow backend on this CPU host.
+
+    python -m generator.gpt2.tune
+
+runs the benchmark workload (see benchmark.py) with every setting of the
+grid, all replicas of a setting at the same time. It writes the fastest
+single process setting and the one with the most tokens per second over
+all replicas to cpu_profile.json in the model directory, where
+GPT2Generator(force_cpu=True) picks them up (see cpu_profile.py).
+"""
+
+import argparse
+import multiprocessing
+import os
+
+from generator.gpt2 import benchmark, cpu_profile
+
+
+def grid(max_replicas_per_socket=4):
+    """Yields the profiles to try: one unpinned process and pinned replicas per socket."""
+    cpus = len(cpu_profile.available_cpus())
+    socket_cpus = min(len(socket) for socket in cpu_profile.sockets())
+
+    for intra in sorted({cpus, max(cpus // 2, 1)}, reverse=True):
+        for inter in (1, 2):
+            yield {
+                "pin": False,
+                "replicas_per_socket": 1,
+                "intra_op_threads": intra,
+                "inter_op_threads": inter,
+            }
+
+    replicas = 1
+    while replicas <= max_replicas_per_socket and socket_cpus // replicas >= 1:
+        share = socket_cpus // replicas
+        for intra in sorted({share, max(share // 2, 1)}, reverse=True):
+            for inter in (1, 2):
+                yield {
+                    "pin": True,
+                    "replicas_per_socket": replicas,
+                    "intra_op_threads": intra,
+                    "inter_op_threads": inter,
+                }
+        replicas *= 2
+
+
+def replica_count(profile):
+    if not profile["pin"]:
+        return 1
+    return profile["replicas_per_socket"] * len(cpu_profile.sockets())
+
+
+def run_replica(profile, replica, settings, generate_num, runs, barrier, results):
+    from generator.gpt2.gpt2_generator import GPT2Generator
+
+    try:
+        generator = GPT2Generator(
+            cache_sessions=0,
+            force_cpu=True,
+            profile={"single": profile, "replicas": profile},
+            replica=replica if profile["pin"] else None,
+            **settings
+        )
+        # Loading takes a different time in every replica, measuring starts together
+        barrier.wait()
+        results.put(benchmark.measure(generator, generate_num=generate_num, runs=runs))
+    except Exception as e:
+        barrier.abort()
+        results.put({"error": repr(e)})
+
+
+def measure(profile, settings, generate_num, runs):
+    """Runs every replica of profile in its own process and sums their throughput."""
+    # Processes are spawned, forking after tensorflow was loaded is not safe
+    context = multiprocessing.get_context("spawn")
+    count = replica_count(profile)
+    barrier = context.Barrier(count)
+    results = context.Queue()
+    processes = [
+        context.Process(
+            target=run_replica,
+            args=(profile, replica, settings, generate_num, runs, barrier, results),
+        )
+        for replica in range(count)
+    ]
+    for process in processes:
+        process.start()
+    measured = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+
+    errors = [m["error"] for m in measured if "error" in m]
+    if errors:
+        return {"error": errors[0]}
+    return {
+        "prefill": max(m["prefill"] for m in measured),
+        "decode": max(m["decode"] for m in measured),
+        "tokens_per_second": sum(m["tokens_per_second"] for m in measured),
+    }
+
+
+def describe(profile):
+    replicas = "unpinned" if not profile["pin"] else "%d/socket" % profile["replicas_per_socket"]
+    return "%s, intra %d, inter %d" % (
+        replicas,
+        profile["intra_op_threads"],
+        profile["inter_op_threads"],
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser("Tune the CPU threads and replicas of GPT2Generator")
+    parser.add_argument("--fixed-cache", action="store_true")
+    parser.add_argument(
+        "--prefill-chunk", type=int, help="Run the prompt this many tokens at a time."
+    )
+    parser.add_argument("--max-replicas-per-socket", type=int, default=4)
+    parser.add_argument("--generate-num", type=int, default=60)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument(
+        "--model-dir",
+        default="generator/gpt2/models/model_v5",
+        help="Where the profile is written, next to the model it was tuned for.",
+    )
+    args = parser.parse_args()
+
+    settings = dict(fixed_cache=args.fixed_cache, prefill_chunk=args.prefill_chunk)
+    # The fastest single process and the fastest over all replicas
+    best = {"single": None, "replicas": None}
+    for profile in grid(args.max_replicas_per_socket):
+        result = measure(profile, settings, args.generate_num, args.runs)
+        if "error" in result:
+            print("%s: failed, %s" % (describe(profile), result["error"]))
+            continue
+        benchmark.report(describe(profile), result)
+        profile = dict(profile, tokens_per_second=result["tokens_per_second"])
+        for key in ["replicas"] if profile["pin"] else ["single", "replicas"]:
+            if (
+                best[key] is None
+                or profile["tokens_per_second"] > best[key]["tokens_per_second"]
+            ):
+                best[key] = profile
+
+    if best["single"] is None:
+        print("No single process setting ran, nothing written")
+        return
+    cpu_profile.save(args.model_dir, dict(best, settings=settings))
+    for key in ("single", "replicas"):
+        print(
+            "Best %s: %s with %.2f tokens/s"
+            % (key, describe(best[key]), best[key]["tokens_per_second"])
+        )
+    print("Written to %s" % os.path.join(args.model_dir, cpu_profile.PROFILE))
+
+
+if __name__ == "__main__":
+    main()
@@ -6,6 +6,7 @@ import time
 import argparse
 
 from generator.gpt2.gpt2_generator import *
+from generator.gpt2.result_cache import ResultCache
 from story import grammars
 from story.story_manager import *
 from story.utils import *
@@ -19,6 +20,45 @@ parser.add_argument(
     action="store_true",
     help="Force using CPU instead of GPU."
 )
+parser.add_argument(
+    "--backend",
+    choices=["tf", "numpy"],
+    default="tf",
+    help="Run the model with TensorFlow or in plain NumPy."
+)
+parser.add_argument(
+    "--quantize",
+    choices=["int8", "float16"],
+    help="Load the weights from their smaller int8 or float16 conversion, needs --backend numpy."
+)
+parser.add_argument(
+    "--xla",
+    action="store_true",
+    help="Compile the TensorFlow graph with XLA."
+)
+parser.add_argument(
+    "--export",
+    help="Load the sampling graph exported to this directory by export_graph.py."
+)
+parser.add_argument(
+    "--candidates",
+    type=int,
+    default=1,
+    help="Sample this many results per action in one batch, /retry shows the others."
+)
+parser.add_argument(
+    "--seed",
+    type=int,
+    help="Seed for the opening of every story, so the same prompt always opens the same way."
+)
+parser.add_argument(
+    "--result-cache",
+    help="Directory where seeded results are cached across runs."
+)
+parser.add_argument(
+    "--draft-model",
+    help="Model next to the main one that proposes tokens for it, needs --backend numpy."
+)
 
 
 def splash():
@@ -144,6 +184,7 @@ def instructions():
     text += '\n Чтобы говорить, введите \'сказать "(то, что вы хотите сказать)"\' или просто "(то, что вы хотите сказать)" '
     text += "\n\nСледующие команды могут быть введены вместо любого действия: "
     text += '\n  "/revert"   Отменяет последнее действие и позволяет переиграть его.'
+    text += '\n  "/retry"    Заменяет последний результат другим вариантом'
     text += '\n  "/quit"     Сохраняет и закрывает игру'
     text += '\n  "/reset"    Сохраняет текущую игру и начинает новую'
     text += '\n  "/restart"  Начинает игру сначала с теми же настройками'
@@ -173,8 +214,18 @@ def play_aidungeon_2(args):
     upload_story = True
 
     print("\nAI Dungeon инициализируется! (Это может занять несколько минут)\n")
-    generator = GPT2Generator(force_cpu=args.cpu)
-    story_manager = UnconstrainedStoryManager(generator)
+    generator = GPT2Generator(
+        force_cpu=args.cpu,
+        backend=args.backend,
+        quantize=args.quantize,
+        xla=args.xla,
+        export_dir=args.export,
+        draft_model=args.draft_model,
+        result_cache=None
+        if args.result_cache is None
+        else ResultCache(args.result_cache),
+    )
+    story_manager = UnconstrainedStoryManager(generator, num_candidates=args.candidates)
     print("\n")
 
     with open("opening.txt", "r", encoding="utf-8") as file:
@@ -211,7 +262,7 @@ def play_aidungeon_2(args):
                 print("\nГенерируем историю...")
 
                 result = story_manager.start_new_story(
-                    prompt, context=context, upload_story=upload_story
+                    prompt, context=context, upload_story=upload_story, seed=args.seed
                 )
                 print("\n")
                 en2ru_translater.set_text(result)
@@ -242,6 +293,8 @@ def play_aidungeon_2(args):
                 elif command == "restart":
                     story_manager.story.actions = []
                     story_manager.story.results = []
+                    story_manager.story.alternates = []
+                    story_manager.story.prune_tokens()
                     console_print("Игра перезапущена.")
                     en2ru_translater.set_text(story_manager.story.story_start)
                     result_translated = en2ru_translater.translate()
@@ -313,8 +366,7 @@ def play_aidungeon_2(args):
                         console_print("Невозможно откатиться дальше. ")
                         continue
 
-                    story_manager.story.actions = story_manager.story.actions[:-1]
-                    story_manager.story.results = story_manager.story.results[:-1]
+                    story_manager.story.revert()
                     console_print("Последнее действие отменено. ")
                     if len(story_manager.story.results) > 0:
                         en2ru_translater.set_text(story_manager.story.results[-1])
@@ -326,6 +378,17 @@ def play_aidungeon_2(args):
                         console_print(result_translated)
                     continue
 
+                elif command == "retry":
+                    if len(story_manager.story.actions) == 0:
+                        console_print("Нечего переигрывать. ")
+                        continue
+
+                    result = story_manager.retry()
+                    en2ru_translater.set_text(result)
+                    result_translated = en2ru_translater.translate()
+                    console_print(result_translated)
+                    continue
+
                 else:
                     console_print(f"Неизвестная команда: {command}")
 
@@ -357,28 +420,50 @@ def play_aidungeon_2(args):
 
                     action = "\n> " + action + "\n"
 
-                result = "\n" + story_manager.act(action)
+                if story_manager.num_candidates > 1:
+                    result = "\n" + story_manager.act(action)
+                    en2ru_translater.set_text(result)
+                    result_translated = en2ru_translater.translate()
+                    held = [result_translated]
+                else:
+                    # Every finished sentence is translated and shown while the rest is
+                    # generated, unless the result could still loop back to the last one
+                    last = None
+                    if len(story_manager.story.results) > 0:
+                        last = story_manager.story.results[-1]
+                    result = "\n"
+                    translated = []
+                    held = []
+                    for chunk in story_manager.act_stream(action):
+                        result += chunk
+                        en2ru_translater.set_text(chunk)
+                        translated.append(en2ru_translater.translate())
+                        held.append(translated[-1])
+                        if last is None or max_similarity(result[1:], last) <= 0.9:
+                            for text in held:
+                                console_print(text)
+                            held = []
+                    result_translated = " ".join(translated)
+
                 if len(story_manager.story.results) >= 2:
                     similarity = get_similarity(
                         story_manager.story.results[-1], story_manager.story.results[-2]
                     )
                     if similarity > 0.9:
-                        story_manager.story.actions = story_manager.story.actions[:-1]
-                        story_manager.story.results = story_manager.story.results[:-1]
+                        story_manager.story.revert()
                         console_print(
                             "Упс, это действие заставило моджель зациклиться. Попробуйте другое действие, чтобы предотвратить это."
                         )
                         continue
 
-                en2ru_translater.set_text(result)
-                result_translated = en2ru_translater.translate()
-                    
+                for text in held:
+                    console_print(text)
+
                 if player_won(result):
-                    console_print(result_translated + "\n ПОЗДРАВЛЯЕМ, ВЫ ВЫИГРАЛИ!")
+                    console_print("ПОЗДРАВЛЯЕМ, ВЫ ВЫИГРАЛИ!")
                     story_manager.story.get_rating()
                     break
                 elif player_died(result):
-                    console_print(result_translated)
                     console_print("ВЫ МЕРТВЫ. ИГРА ОКОНЧЕНА.")
                     console_print("\nВарианты:")
                     console_print("0) Начать новую игру")
@@ -394,9 +479,6 @@ def play_aidungeon_2(args):
                         console_print("Просим прощения за это...где мы остановились?")
                         console_print(result_translated)
 
-                else:
-                    console_print(result_translated)
-
 
 if __name__ == "__main__":
     en2ru_translater = Translater()
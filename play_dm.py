@@ -17,13 +17,16 @@ class AIPlayer:
         self.generator = generator
 
     def get_action(self, prompt):
-        return self.generator.generate_raw(prompt)
+        # Only the first line is kept as the action
+        return self.generator.generate_raw(
+            prompt, stop=["\n"], options={"temperature": 0.9}
+        )
 
 
 def play_dm():
 
     console_print("Initializing AI Dungeon DM Mode")
-    generator = GPT2Generator(temperature=0.9)
+    generator = GPT2Generator()
 
     story_manager = UnconstrainedStoryManager(HumanDM())
     context, prompt = select_game()
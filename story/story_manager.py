@@ -6,6 +6,9 @@ from subprocess import Popen
 
 from story.utils import *
 
+# Format of the token ids in a saved story, saves in another format are encoded again
+TOKENS_VERSION = 1
+
 
 class Story:
     def __init__(
@@ -33,6 +36,14 @@ class Story:
         self.game_state = game_state
         self.memory = 20
 
+        # block text -> token ids, so old blocks are never encoded again
+        self.tokens = {}
+        # Version of the encoder the ids are from
+        self.tokens_encoder = None
+
+        # Other candidates for the last result, served by retry
+        self.alternates = []
+
     def __del__(self):
         if self.upload_story:
             self.save_to_storage()
@@ -51,6 +62,8 @@ class Story:
         self.game_state = story_dict["game_state"]
         self.context = story_dict["context"]
         self.uuid = story_dict["uuid"]
+        self.alternates = story_dict.get("alternates", [])
+        self.load_tokens(story_dict.get("tokens"))
 
         if "rating" in story_dict.keys():
             self.rating = story_dict["rating"]
@@ -61,25 +74,115 @@ class Story:
         story_dict = json.loads(json_string)
         self.init_from_dict(story_dict)
 
-    def add_to_story(self, action, story_block):
+    def add_to_story(self, action, story_block, alternates=()):
         self.actions.append(action)
         self.results.append(story_block)
-
-    def latest_result(self):
+        self.alternates = list(alternates)
+
+    def revert(self):
+        """Drops the last action and result."""
+        self.actions.pop()
+        self.results.pop()
+        self.alternates = []
+        self.prune_tokens()
+
+    def prune_tokens(self):
+        """Forgets the token ids of blocks that are no longer in the story."""
+        texts = set([self.story_start, self.context] + self.actions + self.results)
+        self.tokens = {text: ids for text, ids in self.tokens.items() if text in texts}
+
+    def block_tokens(self, text, enc):
+        """Returns the token ids of a block, encoding it only the first time."""
+        if self.tokens_encoder != enc.version:
+            self.tokens = {}
+            self.tokens_encoder = enc.version
+        if text not in self.tokens:
+            self.tokens[text] = enc.encode(text)
+        return self.tokens[text]
+
+    def latest_blocks(self, max_tokens=None, enc=None):
+        """Lists the start of the story and the latest action/result pairs.
+
+        With max_tokens the pairs are added from the most recent one backwards
+        for as long as they fit in the token budget. The context is always kept.
+        """
 
         mem_ind = self.memory
         if len(self.results) < 2:
-            latest_result = self.story_start
+            blocks = [self.story_start]
         else:
-            latest_result = self.context
-        while mem_ind > 0:
-
-            if len(self.results) >= mem_ind:
-                latest_result += self.actions[-mem_ind] + self.results[-mem_ind]
-
-            mem_ind -= 1
-
-        return latest_result
+            blocks = [self.context]
+
+        if max_tokens is None:
+            while mem_ind > 0:
+
+                if len(self.results) >= mem_ind:
+                    blocks += [self.actions[-mem_ind], self.results[-mem_ind]]
+
+                mem_ind -= 1
+
+            return blocks
+
+        budget = max_tokens - len(self.block_tokens(blocks[0], enc))
+        pairs = []
+        for i in range(1, min(mem_ind, len(self.results)) + 1):
+            pair = [self.actions[-i], self.results[-i]]
+            cost = sum(len(self.block_tokens(block, enc)) for block in pair)
+            if cost > budget:
+                break
+            budget -= cost
+            pairs = pair + pairs
+
+        return blocks + pairs
+
+    def latest_result(self, max_tokens=None, enc=None):
+        """Joins the blocks of latest_blocks into the text of the story so far."""
+        return "".join(self.latest_blocks(max_tokens, enc))
+
+    def latest_tokens(self, max_tokens, enc):
+        """Same as latest_result, but as token ids.
+
+        The ids of every block are encoded on their own and joined, so only
+        blocks that were never used before are encoded. Where a word or a run
+        of whitespace continues over two blocks the ids can differ from
+        encoding the joined text, they still decode to the same text.
+        """
+        tokens = []
+        for block in self.latest_blocks(max_tokens, enc):
+            tokens.extend(self.block_tokens(block, enc))
+        return tokens
+
+    def tokens_to_dict(self):
+        """The ids of the blocks that were encoded, None for the others."""
+
+        def ids(text):
+            return self.tokens.get(text)
+
+        return {
+            "version": TOKENS_VERSION,
+            "encoder": self.tokens_encoder,
+            "story_start": ids(self.story_start),
+            "context": ids(self.context),
+            "actions": [ids(action) for action in self.actions],
+            "results": [ids(result) for result in self.results],
+        }
+
+    def load_tokens(self, tokens_dict):
+        self.tokens = {}
+        self.tokens_encoder = None
+        if tokens_dict is None or tokens_dict.get("version") != TOKENS_VERSION:
+            return
+
+        texts = [self.story_start, self.context] + self.actions + self.results
+        ids = (
+            [tokens_dict["story_start"], tokens_dict["context"]]
+            + tokens_dict["actions"]
+            + tokens_dict["results"]
+        )
+        for text, block_ids in zip(texts, ids):
+            if block_ids is not None:
+                self.tokens[text] = block_ids
+        self.tokens_encoder = tokens_dict["encoder"]
 
     def __str__(self):
         story_list = [self.story_start]
@@ -101,6 +204,8 @@ class Story:
         story_dict["context"] = self.context
         story_dict["uuid"] = self.uuid
         story_dict["rating"] = self.rating
+        story_dict["alternates"] = self.alternates
+        story_dict["tokens"] = self.tokens_to_dict()
 
         return json.dumps(story_dict)
 
@@ -114,6 +219,7 @@ class Story:
         if not os.path.exists(save_path):
             os.makedirs(save_path)
 
+        self.prune_tokens()
         story_json = self.to_json()
         file_name = "story" + str(self.uuid) + ".json"
         f = open(os.path.join(save_path, file_name), "w")
@@ -167,9 +273,10 @@ class StoryManager:
         self.story = None
 
     def start_new_story(
-        self, story_prompt, context="", game_state=None, upload_story=False
+        self, story_prompt, context="", game_state=None, upload_story=False, seed=None
     ):
-        block = self.generator.generate(context + story_prompt)
+        # With a seed the same prompt always opens the same way
+        block = self.generator.generate(context + story_prompt, seed=seed)
         block = cut_trailing_sentence(block)
         self.story = Story(
             context + story_prompt + block,
@@ -211,20 +318,81 @@ class StoryManager:
         return self.story.to_json()
 
     def story_context(self):
-        return self.story.latest_result()
+        """Returns the story context that fits in the generator's token budget."""
+        enc = getattr(self.generator, "enc", None)
+        if enc is None:
+            return self.story.latest_result()
+        return self.story.latest_result(self.generator.max_context_tokens, enc)
+
+    def story_prompt(self, action):
+        """Returns the story context followed by action as token ids.
+
+        Only action is encoded, the blocks of the story were encoded the
+        first time they were part of a prompt. Without an encoder in the
+        generator the prompt is text.
+        """
+        enc = getattr(self.generator, "enc", None)
+        if enc is None:
+            return self.story.latest_result() + action
+        action_tokens = enc.encode(self.generator.prompt_replace(action))
+        max_tokens = self.generator.max_context_tokens - len(action_tokens)
+        return self.story.latest_tokens(max_tokens, enc) + action_tokens
 
 
 class UnconstrainedStoryManager(StoryManager):
+    def __init__(self, generator, num_candidates=1):
+        super().__init__(generator)
+        self.num_candidates = num_candidates
+
     def act(self, action_choice):
 
-        result = self.generate_result(action_choice)
-        self.story.add_to_story(action_choice, result)
+        result, alternates = self.generate_results(action_choice)
+        self.story.add_to_story(action_choice, result, alternates)
         return result
 
     def generate_result(self, action):
-        block = self.generator.generate(self.story_context() + action)
+        block = self.generator.generate(self.story_prompt(action))
         return block
 
+    def generate_results(self, action):
+        """Returns a result for action and the other candidates.
+
+        With num_candidates > 1 they are sampled in one batched run and the
+        first one that does not repeat the last result is picked.
+        """
+        if self.num_candidates <= 1:
+            return self.generate_result(action), []
+        candidates = self.generator.generate_candidates(
+            self.story_prompt(action), self.num_candidates
+        )
+        if len(candidates) == 0:
+            return self.generate_result(action), []
+        if len(self.story.results) > 0:
+            last = self.story.results[-1]
+            candidates.sort(key=lambda c: get_similarity(c, last) > 0.9)
+        return candidates[0], candidates[1:]
+
+    def retry(self):
+        """Replaces the last result with the next alternate, only generates a new one if none is left."""
+        action = self.story.actions.pop()
+        self.story.results.pop()
+        alternates = self.story.alternates
+        if len(alternates) > 0:
+            result, alternates = alternates[0], alternates[1:]
+        else:
+            result, alternates = self.generate_results(action)
+        self.story.add_to_story(action, result, alternates)
+        self.story.prune_tokens()
+        return result
+
+    def act_stream(self, action_choice):
+        """Same as act, but yields the result a few sentences at a time while it is generated."""
+        result = ""
+        for chunk in self.generator.generate_stream(self.story_prompt(action_choice)):
+            result += chunk
+            yield chunk
+        self.story.add_to_story(action_choice, result)
+
 
 class ConstrainedStoryManager(StoryManager):
     def __init__(self, generator, action_verbs_key="classic"):
@@ -33,6 +33,29 @@ def get_similarity(a, b):
     return SequenceMatcher(None, a, b).ratio()
 
 
+def common_subsequence_length(a, b):
+    previous = [0] * (len(b) + 1)
+    for x in a:
+        current = [0]
+        for j, y in enumerate(b):
+            current.append(previous[j] + 1 if x == y else max(previous[j + 1], current[j]))
+        previous = current
+    return previous[-1]
+
+
+def max_similarity(start, b):
+    """Upper bound of get_similarity(start + rest, b) for any rest.
+
+    The matches of SequenceMatcher are a common subsequence, at most the
+    longest one of start and b plus the length of rest, so the ratio is
+    largest when rest adds exactly the characters of b that are missing.
+    """
+    if len(b) == 0:
+        return float(len(start) == 0)
+    common = common_subsequence_length(start, b)
+    return 2 * len(b) / (len(start) + 2 * len(b) - common)
+
+
 def get_num_options(num):
 
     while True:
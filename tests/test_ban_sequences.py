@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+
+from generator.gpt2.src import numpy_sample
+
+# A small vocabulary with the word_breaks of gpt2_generator.word_breaks
+TOKENS = [" ass", " fu", "ck", ".", " and", "\n", "Ass", "ume", " sea", "shell", " fucking"]
+WORD_BREAKS = np.array([1, 1, 0, 3, 1, 3, 0, 0, 1, 0, 1], dtype=np.int32)
+# " ass", " fu" "ck", "Ass" and " fucking"
+BANNED = [[0], [1, 2], [6], [10]]
+# Logits that like the banned tokens best
+PREFERENCE = np.array([9, 8, 10, 1, 2, 3, 7, 5, 4, 6, 11], dtype=np.float32)
+
+
+def sequences_batch(sequences, batch_size):
+    width = max(len(s) for s in sequences)
+    batch = np.full([batch_size, len(sequences), width], -1, dtype=np.int32)
+    for j, seq in enumerate(sequences):
+        batch[:, j, width - len(seq) :] = seq
+    return batch
+
+
+def numpy_ban(logits, output, banned_sequences):
+    return numpy_sample.ban_sequences(logits, output, banned_sequences, WORD_BREAKS)
+
+
+def tf_ban(logits, output, banned_sequences):
+    sample = pytest.importorskip("generator.gpt2.src.sample")
+    tf = sample.tf
+    result = sample.ban_sequences(
+        tf.constant(logits),
+        tf.constant(output),
+        tf.constant(banned_sequences),
+        tf.constant(WORD_BREAKS),
+    )
+    if tf.executing_eagerly():
+        return result.numpy()
+    with tf.Session() as sess:
+        return sess.run(result)
+
+
+def banned_words(output):
+    """The banned sequences in output that start a word."""
+    found = []
+    for seq in BANNED:
+        for end in range(len(seq), len(output) + 1):
+            start = end - len(seq)
+            if list(output[start:end]) != seq:
+                continue
+            if WORD_BREAKS[seq[0]] & 1 or start == 0 or WORD_BREAKS[output[start - 1]] & 2:
+                found.append(seq)
+    return found
+
+
+@pytest.mark.parametrize("ban", [numpy_ban, tf_ban])
+@pytest.mark.parametrize("start", [[], [3], [5], [4], [8]])
+def test_banned_words_never_sampled(ban, start):
+    banned_sequences = sequences_batch(BANNED, 1)
+    output = np.array([start], dtype=np.int32).reshape([1, -1])
+    for _ in range(12):
+        logits = ban(PREFERENCE[np.newaxis], output, banned_sequences)
+        tokens = np.argmax(logits, axis=-1).astype(np.int32)
+        output = np.concatenate([output, tokens[:, np.newaxis]], axis=1)
+    assert banned_words(output[0]) == []
+
+
+@pytest.mark.parametrize("ban", [numpy_ban, tf_ban])
+def test_pieces_inside_words_are_kept(ban):
+    banned_sequences = sequences_batch(BANNED, 2)
+    # "Ass" after " sea" and "ck" after " and" do not start a banned word
+    output = np.array([[8], [4]], dtype=np.int32)
+    logits = ban(np.tile(PREFERENCE, [2, 1]), output, banned_sequences)
+    assert logits[0, 6] == PREFERENCE[6]
+    assert logits[1, 2] == PREFERENCE[2]
+    # At a word start they are masked
+    logits = ban(PREFERENCE[np.newaxis], np.array([[5]], dtype=np.int32), banned_sequences[:1])
+    assert logits[0, 6] < -1e9
+    logits = ban(PREFERENCE[np.newaxis], np.array([[3, 1]], dtype=np.int32), banned_sequences[:1])
+    assert logits[0, 2] < -1e9
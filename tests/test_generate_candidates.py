@@ -0,0 +1,22 @@
+import os
+
+import pytest
+
+pytest.importorskip("profanityfilter")
+if not os.path.exists("generator/gpt2/models/model_v5/hparams.json"):
+    pytest.skip("needs the model, see download_model.sh", allow_module_level=True)
+
+from generator.gpt2.gpt2_generator import GPT2Generator
+
+
+@pytest.fixture(scope="module", params=["tf", "numpy"])
+def generator(request):
+    return GPT2Generator(backend=request.param, force_cpu=True, censor=False, generate_num=30)
+
+
+def test_seeded_candidates_differ_and_repeat(generator):
+    prompt = "You enter the cave. "
+    candidates = generator.generate_candidates(prompt, 4, options={"seed": 3})
+    assert len(candidates) > 1
+    assert len(set(candidates)) == len(candidates)
+    assert generator.generate_candidates(prompt, 4, options={"seed": 3}) == candidates